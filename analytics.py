@@ -0,0 +1,248 @@
+import csv
+import json
+import asyncio
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+from detector import Detector, loadProfile
+
+
+'''
+Historical brew analytics over stored {ts, power} samples
+
+Samples are loaded as NumPy arrays and segmented into off, hot plate and
+brewing episodes with vectorized run-length encoding, using the detector's
+thresholds. A brew is a brewing episode, a re-heat is a hot plate episode that
+starts from off rather than right after a brew. Energy is integrated per
+sample interval, ignoring gaps longer than MAX_GAP. Every brewer is analyzed
+on its own, since the samples of several brewers interleaved in one trace
+would look like a brewer flipping between their states.
+
+python analytics.py --days 30
+python analytics.py --csv samples.csv --json
+'''
+
+MAX_GAP = 60.0  # seconds
+MERGE_GAP = 3  # samples, shorter dips inside an episode are merged into it
+
+OFF = 0
+HOT_PLATE = 1
+BREWING = 2
+
+
+'''
+Classifies every sample as OFF, HOT_PLATE or BREWING. Samples between the hot
+plate band and brewOn take the level of the previous classified sample.
+'''
+
+
+def classify(power: np.ndarray, detector: Detector) -> np.ndarray:
+    levels = np.full(power.shape, -1, dtype=np.int8)
+    levels[power < detector.heatMin] = OFF
+    levels[(power >= detector.heatMin) & (power <= detector.heatMax)] = HOT_PLATE
+    levels[power >= detector.brewOn] = BREWING
+    # Forward fill the unclassified samples
+    known = np.where(levels >= 0, np.arange(len(levels)), 0)
+    np.maximum.accumulate(known, out=known)
+    levels = levels[known]
+    levels[levels < 0] = OFF
+    return levels
+
+
+'''
+Run-length encodes the levels. Returns start indices, end indices (exclusive)
+and the level of every episode.
+'''
+
+
+def episodes(levels: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if (len(levels) == 0):
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([], dtype=np.int8)
+    changes = np.flatnonzero(np.diff(levels)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [len(levels)]))
+    return starts, ends, levels[starts]
+
+
+'''
+Overwrites episodes shorter than MERGE_GAP samples that sit between two
+episodes of the same level, so a brew with a short dip counts once
+'''
+
+
+def mergeShortEpisodes(levels: np.ndarray) -> np.ndarray:
+    starts, ends, kinds = episodes(levels)
+    if (len(kinds) < 3):
+        return levels
+    short = (ends - starts) < MERGE_GAP
+    inner = np.zeros(len(kinds), dtype=bool)
+    inner[1:-1] = short[1:-1] & (kinds[:-2] == kinds[2:])
+    if (not inner.any()):
+        return levels
+    fill = np.repeat(np.where(inner, np.roll(kinds, 1), kinds), ends - starts)
+    return fill.astype(np.int8)
+
+
+def analyze(ts: np.ndarray, power: np.ndarray, detector: Detector,
+            utcOffset: float = 0.0) -> dict:
+    if (len(ts) < 2):
+        return {"samples": int(len(ts)), "brews": 0}
+    order = np.argsort(ts, kind="stable")
+    ts, power = ts[order], power[order]
+
+    # Energy of every sample interval [Wh], trapezoidal, gaps count as no data
+    dt = np.diff(ts, append=ts[-1])
+    dt[dt > MAX_GAP] = 0.0
+    nextPower = np.append(power[1:], power[-1])
+    energy = (power + nextPower) / 2 * dt / 3600
+    cumulative = np.concatenate(([0.0], np.cumsum(energy)))
+
+    levels = mergeShortEpisodes(classify(power, detector))
+    starts, ends, kinds = episodes(levels)
+    episodeEnergy = cumulative[ends] - cumulative[starts]
+    previousKind = np.concatenate(([OFF], kinds[:-1]))
+
+    brew = kinds == BREWING
+    reheat = (kinds == HOT_PLATE) & (previousKind == OFF)
+    brewStarts = ts[starts[brew]]
+    brewDurations = ts[ends[brew] - 1] - brewStarts
+    brewEnergy = episodeEnergy[brew]
+
+    # Local day and hour of every brew start
+    localStarts = brewStarts + utcOffset
+    brewDays = np.floor(localStarts / 86400).astype(np.int64)
+    brewHours = ((localStarts % 86400) // 3600).astype(np.int64)
+    sampleDays = np.floor((ts + utcOffset) / 86400).astype(np.int64)
+    days, dayIndex = np.unique(sampleDays, return_inverse=True)
+    brewsPerDay = np.bincount(np.searchsorted(days, brewDays), minlength=len(days))
+    energyPerDay = np.bincount(dayIndex, weights=energy, minlength=len(days))
+    reheatsPerDay = np.bincount(
+        np.searchsorted(days, np.floor((ts[starts[reheat]] + utcOffset) / 86400).astype(np.int64)),
+        minlength=len(days))
+    brewsPerHour = np.bincount(brewHours, minlength=24)
+
+    epoch = datetime(1970, 1, 1)
+    return {
+        "samples": int(len(ts)),
+        "from": (epoch + timedelta(seconds=float(ts[0] + utcOffset))).isoformat(),
+        "to": (epoch + timedelta(seconds=float(ts[-1] + utcOffset))).isoformat(),
+        "brews": int(brew.sum()),
+        "reheats": int(reheat.sum()),
+        "energyKWh": round(float(cumulative[-1]) / 1000, 3),
+        "brewEnergyWh": {
+            "mean": round(float(brewEnergy.mean()), 1) if len(brewEnergy) else None,
+            "max": round(float(brewEnergy.max()), 1) if len(brewEnergy) else None,
+        },
+        "brewMinutes": {
+            "mean": round(float(brewDurations.mean()) / 60, 1) if len(brewDurations) else None,
+        },
+        "peakHours": [int(hour) for hour in np.argsort(brewsPerHour)[::-1][:3]
+                      if brewsPerHour[hour] > 0],
+        "brewsPerHour": brewsPerHour.tolist(),
+        "perDay": [
+            {"day": (epoch + timedelta(days=int(day))).date().isoformat(),
+             "brews": int(brews), "reheats": int(reheats),
+             "energyWh": round(float(dayEnergy), 1)}
+            for day, brews, reheats, dayEnergy in zip(days, brewsPerDay, reheatsPerDay, energyPerDay)
+        ],
+    }
+
+
+def loadCsv(path: str) -> tuple[np.ndarray, np.ndarray]:
+    ts = []
+    power = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            value = row["ts"]
+            try:
+                ts.append(float(value))
+            except ValueError:
+                ts.append(datetime.fromisoformat(value).timestamp())
+            power.append(float(row["power"]))
+    return np.asarray(ts, dtype=np.float64), np.asarray(power, dtype=np.float64)
+
+
+'''
+Loads the stored samples of every brewer in the range separately, keyed by
+brewer name, or only those of `brewer`. A database without named brewers
+gives all its samples under "", and a single brewer also gets the unnamed
+samples. Unnamed samples next to several named brewers, left from before
+the brewers were named, are not loaded.
+'''
+
+
+async def loadPerBrewer(start: datetime, end: datetime,
+                        brewer: str | None = None) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    from db.backend import createBackend
+    load_dotenv(".env")
+    db = createBackend()
+    try:
+        if (brewer):
+            queries = {brewer: brewer}
+        else:
+            names = await db.brewers(start, end)
+            # A single brewer also gets the samples without a brewer name
+            queries = {name: name for name in names} if len(names) > 1 else {"".join(names): None}
+        result = {}
+        for name, query in queries.items():
+            timestamps, powers = await db.retrieveRange(
+                start, end, brewer=query, batchSize=50000)
+            result[name] = (np.frombuffer(timestamps, dtype=np.float64),
+                            np.frombuffer(powers, dtype=np.float64))
+    finally:
+        await db.close()
+    return result
+
+
+def printReport(result: dict) -> None:
+    print(f"Samples:        {result['samples']} ({result.get('from')} - {result.get('to')})")
+    print(f"Brews:          {result['brews']}")
+    print(f"Re-heats:       {result.get('reheats', 0)}")
+    if (result["brews"]):
+        print(f"Energy:         {result['energyKWh']} kWh, "
+              f"{result['brewEnergyWh']['mean']} Wh per brew on average")
+        print(f"Brew duration:  {result['brewMinutes']['mean']} min on average")
+        print(f"Peak hours:     {', '.join(f'{hour:02d}:00' for hour in result['peakHours'])}")
+    for day in result.get("perDay", []):
+        print(f"  {day['day']}  {day['brews']:3d} brews  {day['reheats']:3d} re-heats  "
+              f"{day['energyWh']:8.1f} Wh")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Brew statistics over stored power samples")
+    parser.add_argument("--days", type=float, default=30, help="days back from now to analyze")
+    parser.add_argument("--brewer", help="only this brewer, default every brewer on its own")
+    parser.add_argument("--csv", help="read ts,power from a CSV file instead of the database")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    if (args.csv):
+        samples = {args.brewer or "": loadCsv(args.csv)}
+    else:
+        end = datetime.now()
+        samples = asyncio.run(loadPerBrewer(end - timedelta(days=args.days), end, args.brewer))
+    utcOffset = datetime.now().astimezone().utcoffset().total_seconds()
+    results = {name: analyze(ts, power, Detector(**loadProfile(name)), utcOffset)
+               for name, (ts, power) in samples.items()}
+    if (len(results) == 1):
+        # A single brewer keeps the flat output
+        result = next(iter(results.values()))
+        if (args.json):
+            print(json.dumps(result, indent=2))
+        else:
+            printReport(result)
+        return
+    if (args.json):
+        print(json.dumps(results, indent=2))
+        return
+    for name, result in results.items():
+        print(f"Brewer {name}")
+        printReport(result)
+        print()
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,94 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+from db.backend import BACKENDS, createBackend
+
+
+'''
+Insert and range read throughput of the storage backends
+
+Writes synthetic samples in batches through insertBatch(), the way the spool
+replicates them, then reads them back with retrieveRange(). Each backend gets
+a scratch collection or table named coffeebot_benchmark, which is dropped
+afterwards, and is configured from .env like the bot. MongoDb also updates
+its rollups on every batch, as in production.
+
+python benchmark.py --samples 100000
+python benchmark.py --backend mysql --batch-size 5000 --json
+'''
+
+SCRATCH = "coffeebot_benchmark"
+
+
+def samples(count: int, brewers: int, seed: int = 1) -> list[dict]:
+    rng = random.Random(seed)
+    start = datetime.now().replace(microsecond=0) - timedelta(seconds=5 * count)
+    return [{"ts": start + timedelta(seconds=5 * (i // brewers)),
+             "power": round(rng.uniform(0.0, 1500.0), 1),
+             "brewer": f"brewer{i % brewers}"}
+            for i in range(count)]
+
+
+async def benchmark(name: str, documents: list[dict], batchSize: int) -> dict:
+    db = createBackend(name, collection=SCRATCH)
+    try:
+        await db.drop()
+        started = time.perf_counter()
+        for i in range(0, len(documents), batchSize):
+            # insert_many adds an _id to the documents, insert copies
+            await db.insertBatch([dict(document) for document in documents[i:i + batchSize]])
+        insertSeconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        timestamps, _ = await db.retrieveRange(
+            documents[0]["ts"], documents[-1]["ts"] + timedelta(seconds=1), batchSize=50000)
+        readSeconds = time.perf_counter() - started
+        await db.drop()
+    finally:
+        await db.close()
+    return {
+        "backend": name,
+        "samples": len(documents),
+        "batchSize": batchSize,
+        "insertSeconds": round(insertSeconds, 3),
+        "insertsPerSecond": round(len(documents) / insertSeconds),
+        "readSamples": len(timestamps),
+        "readsPerSecond": round(len(timestamps) / readSeconds) if readSeconds else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the throughput of the storage backends")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help="backend to benchmark, can be repeated (default all)")
+    parser.add_argument("--samples", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--brewers", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    load_dotenv(".env")
+    documents = samples(args.samples, args.brewers)
+    results = []
+    for name in args.backend or BACKENDS:
+        try:
+            results.append(asyncio.run(benchmark(name, documents, args.batch_size)))
+        except Exception as e:
+            print(f"{name}: {e}", file=sys.stderr)
+    if (args.json):
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'Backend':<10}{'Samples':>10}{'Batch':>8}{'Inserts/s':>12}{'Reads/s':>12}")
+    for result in results:
+        print(f"{result['backend']:<10}{result['samples']:>10}{result['batchSize']:>8}"
+              f"{result['insertsPerSecond']:>12}{result['readsPerSecond'] or '-':>12}")
+
+
+if (__name__ == "__main__"):
+    main()
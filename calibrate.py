@@ -0,0 +1,125 @@
+import os
+import json
+import asyncio
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+
+from detector import PROFILE_FIELDS, profilePath
+
+
+'''
+Calibrates the detector thresholds for a brewer from a recorded trace
+
+Power levels are clustered in a histogram over log(power): samples at or near
+0 W are off, and a weighted 1-D k-means with two centers splits the rest into
+the hot plate level and the brewing level. Thresholds and tolerance are placed
+between the clusters and written as a JSON profile that coffee-bot.py loads
+for the brewer at startup.
+
+python calibrate.py --brewer kitchen --days 14
+python calibrate.py --trace samples.csv
+'''
+
+OFF_LEVEL = 0.5  # Watt, readings at or below are the plug reporting no load
+BINS = 512
+
+
+'''
+Weighted k-means on the histogram bin centers, two clusters
+'''
+
+
+def kmeans(centers: np.ndarray, weights: np.ndarray, iterations: int = 50) -> np.ndarray:
+    nonzero = centers[weights > 0]
+    means = np.array([nonzero.min(), nonzero.max()], dtype=np.float64)
+    for _ in range(iterations):
+        assignment = np.abs(centers[:, None] - means[None, :]).argmin(axis=1)
+        totals = np.bincount(assignment, weights=weights, minlength=2)
+        sums = np.bincount(assignment, weights=weights * centers, minlength=2)
+        updated = np.where(totals > 0, sums / np.maximum(totals, 1e-12), means)
+        if (np.allclose(updated, means)):
+            break
+        means = updated
+    return np.sort(means)
+
+
+def weightedPercentile(values: np.ndarray, weights: np.ndarray, q: float) -> float:
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    index = np.searchsorted(cumulative, q / 100 * cumulative[-1])
+    return float(values[order][min(index, len(values) - 1)])
+
+
+def calibrate(power: np.ndarray) -> dict:
+    on = power[power > OFF_LEVEL]
+    if (len(on) < 10):
+        raise ValueError("Too few samples with the brewer on to calibrate")
+    logPower = np.log10(on)
+    weights, edges = np.histogram(logPower, bins=BINS)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weights = weights.astype(np.float64)
+    low, high = kmeans(centers, weights)
+    if (high - low < 0.5):
+        raise ValueError("Could not find separate hot plate and brewing levels")
+
+    # Split the bins at the midpoint in log space and describe each cluster
+    split = (low + high) / 2
+    lowBins = centers < split
+    lowWeights, highWeights = weights * lowBins, weights * ~lowBins
+    heatLower = 10 ** weightedPercentile(centers, lowWeights, 1)
+    heatUpper = 10 ** weightedPercentile(centers, lowWeights, 99)
+    brewLower = 10 ** weightedPercentile(centers, highWeights, 1)
+    hotPlate = on[on < 10 ** split]
+
+    brewOn = round(brewLower * 0.8, 1)
+    heatMax = round(min(heatUpper * 1.2, brewOn / 2), 1)
+    return {
+        "offMax": OFF_LEVEL,
+        "heatMin": round(max(heatLower * 0.5, OFF_LEVEL * 2), 1),
+        "heatMax": heatMax,
+        "brewOn": brewOn,
+        # Hysteresis: a brew only ends well below where it starts
+        "brewOff": round(float(np.sqrt(heatMax * brewOn)), 1),
+        "tolerance": round(max(float(hotPlate.std()) * 3, 10.0), 1) if len(hotPlate) else 40.0,
+        "confirmSamples": 2,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calibrate detector thresholds from a trace")
+    parser.add_argument("--brewer", default="",
+                        help="brewer name, also used for the profile file; "
+                             "required when the database holds several brewers")
+    parser.add_argument("--trace", help="CSV or mongoexport JSON lines file instead of the database")
+    parser.add_argument("--days", type=float, default=14, help="days of stored data to use")
+    parser.add_argument("--output", help="profile file to write, default in BREWER_PROFILES")
+    args = parser.parse_args()
+
+    if (args.trace):
+        from replay import loadTrace
+        power = np.array([sample[1] for sample in loadTrace(args.trace)], dtype=np.float64)
+    else:
+        from analytics import loadPerBrewer
+        end = datetime.now()
+        samples = asyncio.run(loadPerBrewer(end - timedelta(days=args.days), end, args.brewer or None))
+        # Thresholds fitted to several brewers' samples mixed together fit none of them
+        if (len(samples) > 1):
+            parser.error(f"The database holds several brewers ({', '.join(samples)}), "
+                         "choose one with --brewer")
+        # Names the profile after the only brewer stored
+        args.brewer, (_, power) = next(iter(samples.items()))
+
+    profile = calibrate(power)
+    profile["samples"] = int(len(power))
+    profile["calibrated"] = datetime.now().isoformat(timespec="seconds")
+    output = args.output or profilePath(args.brewer)
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(json.dumps({key: profile[key] for key in PROFILE_FIELDS}, indent=2))
+    print(f"Profile written to {output}")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -3,24 +3,142 @@
 # This code is calibrated for a Moccamaster KBG744 AO-B (double brewer with 2 pots).
 
 """
-TODO: Automatic or semiautomatic calibration
+Other brewer models can be calibrated with calibrate.py, see the README.
 TODO: Approximate amount of coffee made by timing a full pot brewing.
 Problematic with a double brewer, as the second pot is not always started at the same time as the first.
 """
 
 import os
 import time
+import signal
 import asyncio
+import argparse
 import logging
-import requests
+import httpx
 from hue import Hue
-from slack import Slack
-from db.mongodb import MongoDb
+from slack import Slack, newSession
+from scheduler import Scheduler, AdaptiveInterval
+from detector import Detector, OFF, IDLE, HEATING, BREWING, DONE, loadProfile
+from push import PushListener, pushUrlFor, pollUrlFor, powerFromStatus, shellyGeneration
+from notify import Dispatcher, SlackSink, HueSink, WebhookSink, SINK_TIMEOUT, RETRIES
+from history import RecentSamples, StatusApi
+from snapshot import Snapshot
+from supervisor import Supervisor, loadSites, shard
+from metrics import Counter, Gauge, Histogram, MetricsServer
+from db.backend import createBackend
+from db.spool import Spool
+from logconfig import setupLogging
 from dotenv import load_dotenv
 
-# Dict representing brewer state
-STATE = {"brewing": False, "turnedOff": True, "coffeeDone": False}
+logger = logging.getLogger("coffeebot")
+
 MEASURE_INTERVAL = 5  # seconds
+IDLE_INTERVAL = 15  # seconds between samples while the brewer is off
+FAST_INTERVAL = 0.5  # seconds between samples while the power band or the state changes
+FAST_HOLD = 30  # seconds to keep sampling fast after that
+STORE_TOLERANCE = 5.0  # Watt a dropped sample may be off the stored trend
+STORE_MAX_GAP = 60  # seconds, at least one stored sample per gap, see analytics.MAX_GAP
+DRIP_DELAY = 30  # seconds for coffee to drip down after brewing
+SENSOR_TIMEOUT = 3.0  # seconds, a dead plug must not hold up the other brewers
+MAX_SENSOR_CONNECTIONS = 20
+HISTORY_SECONDS = 24 * 3600  # recent samples kept in memory for /history
+
+SENSOR_LATENCY = Histogram(
+    "coffeebot_sensor_request_seconds", "Shelly plug request latency", ["brewer"])
+SENSOR_FAILURES = Counter(
+    "coffeebot_sensor_failures_total", "Sensor reads that failed, measure() returned -1.0", ["brewer"])
+SAMPLE_DURATION = Histogram(
+    "coffeebot_sample_seconds", "Duration of one sampling tick", ["brewer"])
+SAMPLE_DRIFT = Histogram(
+    "coffeebot_sample_drift_seconds", "How late a sample started after its scheduled time",
+    ["brewer"], buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5))
+POWER = Gauge("coffeebot_power_watts", "Last power reading", ["brewer"])
+STATE = Gauge("coffeebot_state", "1 for the current detector state of the brewer", ["brewer", "state"])
+TRANSITIONS = Counter("coffeebot_transitions_total", "Detected state changes", ["brewer", "state"])
+POLL_INTERVAL = Gauge("coffeebot_poll_interval_seconds", "Current sampling interval", ["brewer"])
+
+
+"""
+A single coffee maker behind a Shelly plug, with its own state.
+"""
+
+
+class Brewer:
+    def __init__(self, name: str, sensorUrl: str, clock=None, site: str = ""):
+        self.name = name
+        self.sensorUrl = sensorUrl
+        self.site = site
+        # Unique among the brewers of all sites in a process
+        self.key = f"{site}/{name}" if site else name
+        self.generation = shellyGeneration(sensorUrl)  # Shelly API the plug speaks
+        self.pollUrl = pollUrlFor(sensorUrl)
+        self.push = False  # receive pushed readings instead of polling, Gen2 only
+        # Dict representing brewer state
+        self.state = {"brewing": False, "turnedOff": True, "coffeeDone": False}
+        self.lastPower = None
+        self.lastSample = None  # monotonic time of the last reading
+        self.lastBrewFinished = None  # seconds since the epoch
+        self.announced = {}  # sink key: last status it delivered
+        self.snapshot = None  # Snapshot to notify of changes
+        self.version = 0  # counts the changes of state, part of the /status ETag
+        self.dispatcher = None  # Dispatcher sending the statuses to Slack, Hue and webhooks
+        self.history = RecentSamples(HISTORY_SECONDS)
+        self.detector = Detector(interval=MEASURE_INTERVAL, **loadProfile(name))
+        self.pendingTimer = None  # status waiting for the drip delay
+        # Anything with call_later(), the event loop unless replaying on a virtual clock
+        self.clock = clock
+        self.scheduler = Scheduler(MEASURE_INTERVAL, name=name or sensorUrl)
+        # Samples fast while something happens and slowly while off, None for a fixed interval
+        self.polling = AdaptiveInterval(MEASURE_INTERVAL, IDLE_INTERVAL, FAST_INTERVAL,
+                                        hold=FAST_HOLD)
+        self.metricsLabel = self.key or "default"
+        STATE.labels(brewer=self.metricsLabel, state=self.detector.state).set(1)
+
+    def toSnapshot(self) -> dict:
+        return {"detector": self.detector.state, "state": dict(self.state),
+                "lastBrewFinished": self.lastBrewFinished, "announced": dict(self.announced)}
+
+    def restore(self, snapshot: dict) -> None:
+        STATE.labels(brewer=self.metricsLabel, state=self.detector.state).set(0)
+        self.detector.state = snapshot.get("detector", self.detector.state)
+        STATE.labels(brewer=self.metricsLabel, state=self.detector.state).set(1)
+        self.state.update(snapshot.get("state", {}))
+        self.lastBrewFinished = snapshot.get("lastBrewFinished")
+        announced = snapshot.get("announced")
+        # Snapshots from before the statuses were kept per sink announce again
+        self.announced = dict(announced) if isinstance(announced, dict) else {}
+
+    def changed(self) -> None:
+        self.version += 1
+        if (self.snapshot):
+            self.snapshot.changed()
+
+    def label(self, text: str) -> str:
+        return f"{self.name}: {text}" if self.name else text
+
+    '''
+    Sends a status to all sinks. A newer status supersedes one that is still
+    waiting on a timer.
+    '''
+
+    def announce(self, status: str) -> None:
+        self.cancelTimer()
+        if (self.dispatcher):
+            self.dispatcher.send(self, status)
+
+    '''
+    Sends a status after the given delay without holding up sampling
+    '''
+
+    def announceLater(self, delay: float, status: str) -> None:
+        self.cancelTimer()
+        clock = self.clock or asyncio.get_running_loop()
+        self.pendingTimer = clock.call_later(delay, lambda: self.announce(status))
+
+    def cancelTimer(self) -> None:
+        if (self.pendingTimer):
+            self.pendingTimer.cancel()
+            self.pendingTimer = None
 
 
 """
@@ -29,249 +147,471 @@ Main loop
 
 
 async def main() -> None:
-    # Setup logging
-    logging.basicConfig(
-        filename=time.strftime("%Y-%m-%d %H:%M:%S.log"),
-        format="%(asctime)s %(levelname)s: %(message)s",
-        level=logging.DEBUG,
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    # Logging is configured from .env, and written by a background thread
+    load_dotenv(".env")
+    logListener = setupLogging()
+    try:
+        await run()
+    finally:
+        logListener.stop()
+
 
+async def run() -> None:
     loadAndCheckEnvironment()
+    metricsPort = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+    await runWorker([os.environ], metricsPort)
+
+
+"""
+Runs several sites from a config file (see sites-template.json), sharded
+across worker processes that are restarted if they crash:
+python coffee-bot.py --sites sites.json
+"""
+
+
+def supervise(path: str) -> None:
+    load_dotenv(".env")
+    logListener = setupLogging()
+    try:
+        workers, sites = loadSites(path)
+        valid = []
+        for site in sites:
+            error = checkEnvironment(site, multiSite=True)
+            if (error):
+                logger.error(f"Skipping site {site['SITE_NAME']}: {error}")
+            else:
+                valid.append(site)
+        if (not valid):
+            logger.error("No valid sites to run. Exiting.")
+            quit(1)
+        Supervisor(shard(valid, workers), worker).run()
+    finally:
+        logListener.stop()
+
+
+def worker(index: int, sites: list[dict]) -> None:
+    load_dotenv(".env")
+    root, extension = os.path.splitext(os.getenv("LOG_FILE") or "coffeebot.log")
+    logListener = setupLogging(f"{root}-{index}{extension}")
+    metricsPort = int(os.getenv("METRICS_PORT")) + index if os.getenv("METRICS_PORT") else None
+    try:
+        # Nobody is at the terminal of a worker to answer prompts
+        asyncio.run(runWorker(sites, metricsPort, interactive=False))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # Stopped by Ctrl-C or the supervisor
+        pass
+    finally:
+        logListener.stop()
+
+
+"""
+Runs the sites of one process. The sites share the HTTP server for metrics
+and status, the connection pools to the plugs and to Slack, and the database
+clients.
+"""
+
 
-    sensor_url = os.getenv("SENSOR_URL")
+async def runWorker(sites: list, metricsPort: int | None = None,
+                    interactive: bool = True) -> None:
+    # Let the supervisor stop the worker cleanly
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
+    # Metrics and the status API, so dashboards never poll the plugs
+    statusApi = StatusApi()
+    metricsServer = None
+    if (metricsPort):
+        metricsServer = MetricsServer(port=metricsPort)
+        statusApi.register(metricsServer)
+        await metricsServer.start()
+
+    # One connection pool shared by all plugs
+    limits = httpx.Limits(max_connections=MAX_SENSOR_CONNECTIONS,
+                          max_keepalive_connections=MAX_SENSOR_CONNECTIONS)
+    slackSession = newSession()
+    try:
+        async with httpx.AsyncClient(timeout=SENSOR_TIMEOUT, limits=limits) as client:
+            await asyncio.gather(
+                *(runSite(env, client, slackSession, statusApi, interactive) for env in sites))
+    finally:
+        await slackSession.aclose()
+        if (metricsServer):
+            await metricsServer.close()
+
+
+"""
+Runs the brewers of one site, configured by env: the environment, or one site
+of a multi-site config
+"""
+
+
+async def runSite(env, client: httpx.AsyncClient, slackSession: httpx.AsyncClient,
+                  statusApi: StatusApi, interactive: bool = True) -> None:
+    site = env.get("SITE_NAME") or ""
+    prefix = f"{site}-" if site else ""
+    brewers = parseBrewers(env.get("SENSOR_URL"), site)
+    for brewer in brewers:
+        brewer.push = env.get("SENSOR_MODE") == "push"
+        if (brewer.push and brewer.generation == 1):
+            logger.warning(f"{brewer.key or brewer.sensorUrl} is a Gen1 plug, which cannot push "
+                           "readings, polling it instead")
+            brewer.push = False
+        if (env.get("ADAPTIVE_POLLING") == "False"):
+            brewer.polling = None
+    statusApi.add(brewers)
+
+    # Resume where the last run left off. Slack needs no requests to start,
+    # and the Hue lights are looked up in the background while sampling runs
+    # with the lights from the snapshot.
+    snapshot = Snapshot(env.get("STATE_PATH") or f"{prefix}coffeebot-state.json")
+    saved = snapshot.load()
     slack = None
     hue = None
-    if (os.getenv("USE_SLACK") == "True"):
-        slack = Slack()
-    if (os.getenv("USE_HUE") == "True"):
-        hue = Hue()
-        hue.getLightsV2()
+    hueSetup = None
+    if (env.get("USE_SLACK") == "True"):
+        slack = Slack(env.get("SLACK_TOKEN"), env.get("CHANNEL_ID"), session=slackSession)
+        slack.restore(saved.get("slack", {}))
+    if (env.get("USE_HUE") == "True"):
+        hue = Hue(env.get("HUE_IP"), env.get("HUE_GROUP") or "", env.get("HUE_USERNAME"),
+                  interactive=interactive)
+        hue.restore(saved.get("hue", {}))
+        hueSetup = asyncio.create_task(hue.getLightsV2())
+    # Every status goes to all sinks concurrently
+    sinkOptions = {"timeout": float(env.get("NOTIFY_TIMEOUT") or SINK_TIMEOUT),
+                   "retries": int(env.get("NOTIFY_RETRIES") or RETRIES)}
+    sinks = []
+    if (slack):
+        sinks.append(SlackSink(slack, **sinkOptions))
+    if (hue):
+        sinks.append(HueSink(hue, **sinkOptions))
+    for url in (env.get("WEBHOOK_URLS") or "").split(","):
+        if (url.strip()):
+            sinks.append(WebhookSink(url.strip(), **sinkOptions))
+    dispatcher = Dispatcher(sinks)
+
+    for brewer in brewers:
+        brewer.restore(saved.get("brewers", {}).get(brewer.name, {}))
+        brewer.snapshot = snapshot
+        brewer.dispatcher = dispatcher
+        if (brewer.detector.state == DONE):
+            # Stopped during the drip delay or before every sink had the
+            # status, announce the coffee to the sinks that missed it
+            dispatcher.resend(brewer, "done")
+    snapshot.collect = lambda: {
+        "brewers": {brewer.name: brewer.toSnapshot() for brewer in brewers},
+        "slack": slack.toSnapshot() if slack else {},
+        "hue": hue.toSnapshot() if hue else {},
+    }
+    snapshot.start()
 
     db = None
-    if (os.getenv("STORE_DATA") == "True"):
-        logging.info("Connecting to MongoDb Database...")
-        try:
-            db = MongoDb(
-                url=os.getenv("MONGODB_CONNECTION_STRING"),
-                db=os.getenv("MONGODB_DATABASE"),
-                collection=os.getenv("MONGODB_COLLECTION"),
-            )
-            logging.info("MongoDb Database connection successful")
-        except Exception as e:
-            logging.error(f"Failed to connect to MongoDb Database: {e}")
-            quit(1)
+    if (env.get("STORE_DATA") == "True"):
+        # Samples are spooled on disk and replicated to the database in the
+        # background, so the bot keeps sampling while it is unreachable
+        db = Spool(
+            env.get("SPOOL_PATH") or f"{prefix}spool.sqlite3",
+            lambda: createBackend(env=env, shared=True),
+            batchSize=int(env.get("MONGODB_BATCH_SIZE") or 1000),
+            replicateInterval=float(env.get("MONGODB_FLUSH_INTERVAL") or 300),
+            tolerance=parseTolerance(env.get("STORE_TOLERANCE")),
+            maxGap=float(env.get("STORE_MAX_GAP") or STORE_MAX_GAP),
+        )
+        db.start()
+
+    try:
+        await asyncio.gather(
+            *(watch(brewer, client, db) for brewer in brewers))
+    finally:
+        if (hueSetup):
+            hueSetup.cancel()
+        await dispatcher.close()
+        await snapshot.close()
+        if (slack):
+            await slack.close()
+        if (hue):
+            await hue.close()
+        if (db):
+            # Replicate what is spooled before exiting
+            await db.close()
+
+
+"""
+Monitoring loop for one brewer. Each brewer runs as its own task, so a slow
+or dead plug only delays its own loop. Samples are taken on a steady cadence;
+handlers only update the state and hand their statuses to the dispatcher,
+which delivers them in the background so they never delay the next sample.
+"""
+
+
+async def watch(brewer: Brewer, client: httpx.AsyncClient, db: Spool | None) -> None:
+    logger.info(f"Watching brewer '{brewer.key}' at {brewer.sensorUrl}")
+
+    listener = None
+    if (brewer.push):
+        listener = PushListener(
+            pushUrlFor(brewer.sensorUrl),
+            lambda power: process(brewer, power, db),
+            name=brewer.key)
+        listenerTask = asyncio.create_task(listener.run())
+
+    sampleDuration = SAMPLE_DURATION.labels(brewer=brewer.metricsLabel)
+    sampleDrift = SAMPLE_DRIFT.labels(brewer=brewer.metricsLabel)
+
+    async def tick(drift: float) -> None:
+        logger.debug("%s sample drift %.1f ms", brewer.name, drift * 1000)
+        sampleDrift.observe(drift)
+        with sampleDuration.time():
+            if (listener and listener.connected and brewer.lastPower is not None):
+                # The plug only pushes changes, feed the last reading to the
+                # detector again to keep the cadence, without storing it
+                await process(brewer, brewer.lastPower, db, repeated=True)
+                return
+            power = await measure(client, brewer)
+            if (power == -1.0):
+                # An exception occured, measure again next tick
+                return
+            await process(brewer, power, db)
+
+    try:
+        await brewer.scheduler.run(tick)
+    finally:
+        brewer.cancelTimer()
+        if (listener):
+            listenerTask.cancel()
+
+
+"""
+Stores a power reading and feeds it to the detector, for polled and pushed
+readings alike, then picks the interval until the next sample. A repeated
+reading, the last pushed one fed again on a tick, only goes to the detector.
+"""
+
+
+async def process(brewer: Brewer, power: float, db: Spool | None,
+                  repeated: bool = False) -> None:
+    now = time.monotonic()
+    seconds = now - brewer.lastSample if brewer.lastSample is not None else None
+    brewer.lastSample = now
+    if (not repeated):
+        brewer.lastPower = power
+        brewer.history.append(time.time(), power)
+        POWER.labels(brewer=brewer.metricsLabel).set(power)
+        if (db):
+            await db.store(power, brewer=brewer.name or None)
+    previous = brewer.detector.state
+    detect(brewer, power, seconds)
+    if (brewer.polling):
+        detector = brewer.detector
+        # Standby draw flickering around offMax is no change worth sampling fast
+        band = detector.band(power)
+        interval = brewer.polling.next(
+            OFF if band == IDLE else band, busy=detector.transitional(),
+            quiet=detector.state in (OFF, IDLE) and power < detector.heatMin, now=now)
+        brewer.scheduler.setInterval(interval)
+        POLL_INTERVAL.labels(brewer=brewer.metricsLabel).set(interval)
+    if (brewer.detector.state != previous):
+        label = brewer.metricsLabel
+        STATE.labels(brewer=label, state=previous).set(0)
+        STATE.labels(brewer=label, state=brewer.detector.state).set(1)
+        TRANSITIONS.labels(brewer=label, state=brewer.detector.state).inc()
+        if (brewer.detector.state == DONE):
+            brewer.lastBrewFinished = time.time()
+        brewer.changed()
 
-    while (True):
-        power = await measure(sensor_url, db=db)
-        if (power == -1.0):
-            # Power is still changing or an exception occured, wait and measure again
-            time.sleep(MEASURE_INTERVAL / 2)
-            continue
 
-        # Heating old coffee
-        elif (
-            (power > 1.0)
-            and (power <= 300.0)
-            and not STATE["brewing"]
-            and not STATE["coffeeDone"]
-        ):
-            heatingOldCoffee(hue, slack)
+"""
+Feeds a power reading, taken `seconds` after the previous one, to the
+brewer's detector and acts on state changes
+"""
+
 
-        # Fresh coffee has been made
-        elif (power > 1.0 and power <= 300.0 and STATE["brewing"]):
-            freshCoffeeHasBeenMade(hue, slack)
+def detect(brewer: Brewer, power: float, seconds: float | None = None) -> None:
+    transition = brewer.detector.update(power, seconds)
 
-        # Coffee is brewing
-        elif (power > 1000.0 and not STATE["brewing"]):
-            coffeeIsBrewing(hue, slack)
+    # Heating old coffee
+    if (transition == HEATING):
+        heatingOldCoffee(brewer)
 
-        # Still brewing, make lights blink
-        elif (power > 1000.0 and STATE["brewing"]):
-            stillBrewing(hue)
+    # Fresh coffee has been made
+    elif (transition == DONE):
+        freshCoffeeHasBeenMade(brewer)
 
-        # Coffee maker turned off
-        elif (power == 0.0 and not STATE["turnedOff"]):
-            coffeeMakerTurnedOff(hue, slack)
+    # Coffee is brewing
+    elif (transition == BREWING):
+        coffeeIsBrewing(brewer)
 
-        # Idle, don't send messages
-        elif (power == 0.0 and STATE["turnedOff"]):
-            time.sleep(MEASURE_INTERVAL)
-            continue
+    # Still brewing, make lights blink
+    elif (brewer.detector.state == BREWING):
+        stillBrewing(brewer)
+
+    # Coffee maker turned off
+    elif (transition == OFF and not brewer.state["turnedOff"]):
+        coffeeMakerTurnedOff(brewer)
+
+    # Idle, don't send messages
+
+
+"""
+Parses SENSOR_URL into brewers. The variable holds one or more comma separated
+plug URLs, each optionally prefixed with a name, e.g.
+"kitchen=http://192.168.0.10/meter/0,floor2=http://192.168.0.11/meter/0"
+"""
 
-        time.sleep(MEASURE_INTERVAL)
+
+def parseBrewers(sensor_urls: str, site: str = "") -> list[Brewer]:
+    brewers = []
+    entries = [entry.strip() for entry in sensor_urls.split(",") if entry.strip()]
+    for entry in entries:
+        name, separator, url = entry.partition("=")
+        if (not separator or "://" in name):
+            name, url = "", entry
+        if (not name and len(entries) > 1):
+            name = f"Brewer {len(brewers) + 1}"
+        brewers.append(Brewer(name.strip(), url.strip(), site=site))
+    return brewers
 
 
 def loadAndCheckEnvironment():
     env_loaded = load_dotenv(".env")  # Load environment variables
     if (not env_loaded):
-        logging.error("Could not load .env file. Exiting.")
+        logger.error("Could not load .env file. Exiting.")
         quit(1)
-    try:
-        sensor_url = os.getenv("SENSOR_URL")
-        if (sensor_url == "" or sensor_url is None):
-            raise KeyError
-    except KeyError:
-        logging.error("Could not parse SENSOR_URL in the file '.env'. Exiting.")
+    error = checkEnvironment(os.environ)
+    if (error):
+        logger.error(f"{error} Exiting.")
         quit(1)
 
-    try:
-        use_slack = os.getenv("USE_SLACK") == "True"
-        slack_token = os.getenv("SLACK_TOKEN")
-        slack_channel = os.getenv("SLACK_CHANNEL")
-        use_hue = os.getenv("USE_HUE") == "True"
-        hue_ip = os.getenv("HUE_IP")
-        store_data = os.getenv("STORE_DATA") == "True"
-        mongodb_connection_string = os.getenv("MONGODB_CONNECTION_STRING")
-        mongodb_database = os.getenv("MONGODB_DATABASE")
-        mongodb_collection = os.getenv("MONGODB_COLLECTION")
-
-        if (not use_slack and not use_hue and not store_data):
-            logging.error("No services enabled. Exiting.")
-            quit(1)
-        elif (use_slack and (slack_token == "" or slack_channel == "")):
-            logging.error(
-                "Slack is active but missing auth token and/or channel ID. Exiting."
-            )
-            quit(1)
-        elif (use_hue and hue_ip == ""):
-            logging.error("Hue is active but missing bridge IP address. Exiting.")
-            quit(1)
-        elif (store_data and (
-            mongodb_connection_string == ""
-            or mongodb_database == ""
-            or mongodb_collection == ""
-        )):
-            logging.error(
-                "Storing data is active but missing MongoDB connection string, database name or collection name. Exiting."
-            )
-            quit(1)
 
-    except KeyError:
-        logging.error(
-            "Could not parse one or more environment variables in the file '.env'. Exiting."
-        )
-        quit(1)
+"""
+Checks the settings of a site, the environment or one site of a multi-site
+config. Returns what is wrong, or None.
+"""
+
+
+def checkEnvironment(env, multiSite: bool = False) -> str | None:
+    if (not env.get("SENSOR_URL")):
+        return "Could not parse SENSOR_URL."
+
+    use_slack = env.get("USE_SLACK") == "True"
+    use_hue = env.get("USE_HUE") == "True"
+    store_data = env.get("STORE_DATA") == "True"
+    backend = (env.get("STORAGE_BACKEND") or "mongodb").lower()
+
+    if (not use_slack and not use_hue and not store_data and not env.get("WEBHOOK_URLS")):
+        return "No services enabled."
+    elif (use_slack and (not env.get("SLACK_TOKEN") or not env.get("CHANNEL_ID"))):
+        return "Slack is active but missing auth token and/or channel ID."
+    elif (use_hue and not env.get("HUE_IP")):
+        return "Hue is active but missing bridge IP address."
+    elif (use_hue and multiSite and not env.get("HUE_USERNAME")):
+        # The hue_username file only holds the key of one bridge
+        return "Hue is active but missing HUE_USERNAME, which every site needs."
+    elif (store_data and backend == "mongodb" and (
+        not env.get("MONGODB_CONNECTION_STRING")
+        or not env.get("MONGODB_DATABASE")
+        or not env.get("MONGODB_COLLECTION")
+    )):
+        return "Storing data is active but missing MongoDB connection string, database name or collection name."
+    elif (store_data and backend == "mysql" and (
+        not env.get("DB_HOST") or not env.get("DB_DATABASE") or not env.get("DB_TABLE")
+    )):
+        return "Storing data is active but missing MySQL host, database name or table name."
+    return None
 
 
 """
-Polls the Shelly embedded web server for power usage [Watt] twice with MEASURE_INTERVAL seconds between.
-If databse is active, stores the values in the MongoDB database.
-Returns second value if valid measure, -1.0 otherwise.
+Parses STORE_TOLERANCE, "off" stores every sample without compression
 """
 
 
-async def measure(sensor_url: str, db: MongoDb | None) -> float:
-    tolerance = 40.0
-    try:
-        response = requests.request("GET", sensor_url)
-    except Exception as e:
-        logging.error(e)
-        return -1.0
-    value1 = float(response.json()["power"])
-    if (db):
-        await db.store(value1)
-    # Increase tolerance for higher values
-    if (value1 > 2000.0):
-        tolerance = 80
-    logging.debug(f"{value1} Watt")
-    time.sleep(MEASURE_INTERVAL)
-    try:
-        response = requests.request("GET", sensor_url)
-    except Exception as e:
-        print(e)
-        return -1.0
-    value2 = float(response.json()["power"])
-    if (db):
-        await db.store(value2)
-    logging.debug(f"{value2} Watt")
-
-    # If diff is larger than tolerance, the power is still changing
-    # Diffs lower than 1.0 are ignored
-    if (value1 == 0.0 and value2 == 0.0):
-        return value2
-    elif (abs(value1 - value2) <= tolerance and abs(value1 - value2) > 1.0):
-        return value2
-    else:
-        return -1.0
+def parseTolerance(value: str | None) -> float | None:
+    if ((value or "").strip().lower() == "off"):
+        return None
+    return float(value) if value else STORE_TOLERANCE
 
 
 """
-Resets global dict respresenting the brewer state
+Polls the Shelly embedded web server for power usage [Watt] once.
+Returns the value, or -1.0 if the plug could not be read.
 """
 
 
-def resetState() -> None:
-    STATE["brewing"] = False
-    STATE["turnedOff"] = True
-    STATE["coffeeDone"] = False
+async def measure(client: httpx.AsyncClient, brewer: Brewer) -> float:
+    try:
+        with SENSOR_LATENCY.labels(brewer=brewer.metricsLabel).time():
+            response = await client.get(brewer.pollUrl)
+        power = powerFromStatus(brewer.generation, response.json())
+    except Exception as e:
+        logger.error(f"{brewer.name or brewer.sensorUrl}: {e}")
+        SENSOR_FAILURES.labels(brewer=brewer.metricsLabel).inc()
+        return -1.0
+    logger.debug("%s %s Watt", brewer.name, power)
+    return power
 
 
 """
-Messaging and Hue control functions
+Resets the dict respresenting the brewer state
 """
 
 
-def heatingOldCoffee(hue: Hue | None, slack: Slack | None) -> None:
-    logging.info("Heating old coffee.")
-    if (slack):
-        slack.deleteLastMessage()
-        slack.postMessage(slack.messages["saving"])
+def resetState(brewer: Brewer) -> None:
+    brewer.state["brewing"] = False
+    brewer.state["turnedOff"] = True
+    brewer.state["coffeeDone"] = False
 
-    if (hue):
-        hue.setAllLightsV2(0.1673, 0.5968)  # green
 
-    STATE["coffeeDone"] = True
-    STATE["turnedOff"] = False
+"""
+Handlers for the state changes
+Handlers update the brewer state right away and announce the new status,
+which the dispatcher sends to Slack, Hue and the webhooks.
+"""
 
 
-def coffeeIsBrewing(hue: Hue | None, slack: Slack | None) -> None:
-    logging.info("Coffee is brewing.")
-    if (slack):
-        slack.deleteLastMessage()
-        slack.postMessage(slack.messages["brewing"])
+def heatingOldCoffee(brewer: Brewer) -> None:
+    logger.info(brewer.label("Heating old coffee."))
+    brewer.announce("saving")
 
-    if (hue):
-        hue.setAllLightsV2(0.4878, 0.4613)  # yellow
+    brewer.state["coffeeDone"] = True
+    brewer.state["turnedOff"] = False
 
-    STATE["brewing"] = True
-    STATE["turnedOff"] = False
 
+def coffeeIsBrewing(brewer: Brewer) -> None:
+    logger.info(brewer.label("Coffee is brewing."))
+    brewer.announce("brewing")
 
-def freshCoffeeHasBeenMade(hue: Hue | None, slack: Slack | None) -> None:
-    time.sleep(30)  # Wait 30 seconds for coffee to drip down
-    logging.info("Fresh coffee has been made.")
-    if (slack):
-        slack.deleteLastMessage()
-        slack.postMessage(slack.messages["done"])
+    brewer.state["brewing"] = True
+    brewer.state["turnedOff"] = False
 
-    if (hue):
-        hue.setAllLightsV2(0.1673, 0.5968)  # green
 
-    STATE["coffeeDone"] = True
-    STATE["brewing"] = False
+def freshCoffeeHasBeenMade(brewer: Brewer) -> None:
+    logger.info(brewer.label("Fresh coffee has been made."))
+    # Wait for coffee to drip down before announcing it, sampling continues meanwhile
+    brewer.announceLater(DRIP_DELAY, "done")
 
+    brewer.state["coffeeDone"] = True
+    brewer.state["brewing"] = False
 
-def stillBrewing(hue: Hue | None) -> None:
-    if (hue):
-        hue.turnOffAllLightsV2()
-        time.sleep(1)
-        hue.setAllLightsV2(0.4878, 0.4613)  # yellow
 
+def stillBrewing(brewer: Brewer) -> None:
+    # Restart the blink if something else has stopped it
+    if (brewer.dispatcher):
+        brewer.dispatcher.refresh(brewer, "brewing")
 
-def coffeeMakerTurnedOff(hue: Hue | None, slack: Slack | None) -> None:
-    logging.info("Coffee maker turned off.")
-    resetState()
-    if (slack):
-        slack.deleteLastMessage()
-        slack.postMessage(slack.messages["off"])
 
-    if (hue):
-        hue.setAllLightsV2(0.6758, 0.3008)  # red
+def coffeeMakerTurnedOff(brewer: Brewer) -> None:
+    logger.info(brewer.label("Coffee maker turned off."))
+    resetState(brewer)
+    brewer.announce("off")
 
 
 if (__name__ == "__main__"):
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Coffee bot")
+    parser.add_argument("--sites", help="JSON file with several sites to run, see sites-template.json")
+    args = parser.parse_args()
+    if (args.sites):
+        supervise(args.sites)
+    else:
+        try:
+            asyncio.run(main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Stopped by Ctrl-C or SIGTERM, e.g. from docker stop
+            pass
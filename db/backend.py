@@ -0,0 +1,113 @@
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from array import array
+
+
+'''
+Interface of the storage backends
+
+A backend stores {ts, power, brewer} samples one at a time with store() or in
+batches with insertBatch(), and reads a time range back as two columns with
+retrieveRange(), and lists the brewers in a time range with brewers().
+Implemented by MongoDb in db/mongodb.py and MySql in
+db/mysql.py; createBackend() picks one from STORAGE_BACKEND in the
+environment. Drivers are imported on use, so only the selected backend's
+driver has to be installed. A backend that leaves out one of the abstract
+methods fails when it is created.
+'''
+
+BACKENDS = ("mongodb", "mysql")
+
+
+class StorageBackend(ABC):
+    def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    '''
+    Stores one sample. Returns False if the sample was dropped.
+    '''
+
+    @abstractmethod
+    async def store(self, value: float, ts: datetime | None = None,
+                    brewer: str | None = None) -> bool:
+        raise NotImplementedError
+
+    '''
+    Stores a batch of {ts, power, brewer} documents. Raises if the batch was
+    not stored, so the caller can retry it. Documents with an "_id" that is
+    already stored are skipped, so a retried batch is not stored twice.
+    '''
+
+    @abstractmethod
+    async def insertBatch(self, documents: list[dict]) -> None:
+        raise NotImplementedError
+
+    '''
+    Returns the samples with start <= ts < end as two columns: timestamps in
+    seconds since the epoch and power [Watt], both as arrays of doubles.
+    Raises if the read fails, rather than returning a truncated range.
+    '''
+
+    @abstractmethod
+    async def retrieveRange(self, start: datetime, end: datetime,
+                            brewer: str | None = None,
+                            batchSize: int = 5000) -> tuple[array, array]:
+        raise NotImplementedError
+
+    '''
+    Returns the names of the brewers with samples in start <= ts < end, sorted.
+    Samples stored without a brewer name are not listed.
+    '''
+
+    @abstractmethod
+    async def brewers(self, start: datetime, end: datetime) -> list[str]:
+        raise NotImplementedError
+
+    '''
+    Removes all stored samples, used by benchmark.py on its scratch tables
+    '''
+
+    @abstractmethod
+    async def drop(self) -> None:
+        raise NotImplementedError
+
+
+'''
+Creates the backend named by STORAGE_BACKEND (default mongodb), configured
+from env, the environment unless a site config is passed. `collection`
+overrides the MongoDb collection or MySQL table name. With shared set,
+backends for the same server share one client or connection pool.
+'''
+
+
+def createBackend(name: str | None = None, collection: str | None = None,
+                  env=os.environ, shared: bool = False) -> StorageBackend:
+    name = (name or env.get("STORAGE_BACKEND") or "mongodb").lower()
+    batchSize = int(env.get("MONGODB_BATCH_SIZE") or 1000)
+    if (name == "mongodb"):
+        from db.mongodb import MongoDb
+        return MongoDb(
+            url=env.get("MONGODB_CONNECTION_STRING"),
+            db=env.get("MONGODB_DATABASE"),
+            collection=collection or env.get("MONGODB_COLLECTION"),
+            batchSize=batchSize,
+            rawRetentionDays=float(env.get("MONGODB_RAW_RETENTION_DAYS") or 0) or None,
+            shared=shared,
+        )
+    if (name == "mysql"):
+        from db.mysql import MySql
+        return MySql(
+            host=env.get("DB_HOST"),
+            user=env.get("DB_USER"),
+            password=env.get("DB_PASSWORD"),
+            database=env.get("DB_DATABASE"),
+            table=collection or env.get("DB_TABLE"),
+            sslCa=env.get("DB_PATH_TO_SSL_CA") or None,
+            poolSize=int(env.get("DB_POOL_SIZE") or 4),
+            shared=shared,
+        )
+    raise ValueError(f"Unknown storage backend '{name}', expected one of {', '.join(BACKENDS)}")
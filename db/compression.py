@@ -0,0 +1,71 @@
+import math
+
+
+'''
+Swinging door compression of one series of samples
+
+A sample is only stored when the line from the last stored sample to the
+newest one no longer passes within `tolerance` of every sample in between.
+Then the previous sample is stored and starts the next line. Interpolating
+linearly between the stored samples gives every dropped sample back within
+tolerance, so a flat 0 W night collapses to one sample per `maxGap` seconds,
+which is always stored so gaps in the data still show when the bot was down.
+'''
+
+
+class SwingingDoor:
+    def __init__(self, tolerance: float, maxGap: float = 60.0):
+        self.tolerance = tolerance
+        self.maxGap = maxGap
+        self.stored = None  # (ts, value) last stored sample
+        self.held = None  # (ts, value) latest sample, not stored yet
+        # Slopes of the lines from the stored sample that pass within
+        # tolerance of every sample since
+        self.upper = math.inf
+        self.lower = -math.inf
+        self.dropped = 0
+
+    '''
+    Adds a sample. Returns the samples to store, oldest first.
+    '''
+
+    def add(self, ts: float, value: float) -> list[tuple[float, float]]:
+        result = []
+        if (self.held is not None and not self.fits(ts, value)):
+            result.append(self.held)
+            self.store(self.held)
+        if (self.stored is None or not self.fits(ts, value)):
+            result.append((ts, value))
+            self.store((ts, value))
+            return result
+        storedTs, storedValue = self.stored
+        self.upper = min(self.upper, (value + self.tolerance - storedValue) / (ts - storedTs))
+        self.lower = max(self.lower, (value - self.tolerance - storedValue) / (ts - storedTs))
+        if (self.held is not None):
+            self.dropped += 1
+        self.held = (ts, value)
+        return result
+
+    '''
+    Returns the sample that is held back, if any, so it can be stored on exit
+    '''
+
+    def flush(self) -> list[tuple[float, float]]:
+        if (self.held is None):
+            return []
+        held = self.held
+        self.store(held)
+        return [held]
+
+    def fits(self, ts: float, value: float) -> bool:
+        storedTs, storedValue = self.stored
+        elapsed = ts - storedTs
+        if (elapsed <= 0 or elapsed > self.maxGap):
+            return False
+        return self.lower <= (value - storedValue) / elapsed <= self.upper
+
+    def store(self, sample: tuple[float, float]) -> None:
+        self.stored = sample
+        self.held = None
+        self.upper = math.inf
+        self.lower = -math.inf
@@ -1,6 +1,16 @@
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid
+from datetime import datetime, timedelta
+from collections import deque
+from array import array
+from itertools import islice
+import asyncio
 import logging
+import threading
+from db.backend import StorageBackend
+from metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
 
 
 '''
@@ -8,34 +18,463 @@ MongoDb class responsible for storing and retrieving data from MongoDB
 
 An MongoDB Atlas free tier with 5GB storage will hold about 2 months of data
 when storing a value every 5 seconds.
+
+Samples are not written one by one. store() appends them to a bounded
+in-memory buffer, and a background task started with start() writes them with
+insert_many when batchSize samples are waiting or flushInterval seconds have
+passed. When the buffer is full the overflow policy decides what happens:
+    "drop-oldest"  discard the oldest buffered sample (default)
+    "drop-newest"  discard the incoming sample
+    "block"        make store() wait until a flush has made room
+close() flushes whatever is left. coffee-bot.py writes through db/spool.py
+instead, which keeps the samples on disk and hands them over with
+insertBatch().
+
+Raw samples go to a native time-series collection with "ts" as time field and
+"brewer" as meta field, which MongoDB stores in compressed buckets. Raw samples
+can be expired after rawRetentionDays. Per-minute and per-hour rollups with
+min, max, mean, count, energy [Wh] and seconds are kept in the collections
+<collection>_1m and <collection>_1h, updated on every flush, and are never
+expired. Samples come at an adaptive interval and are swinging door
+compressed, so `count` is only the number of stored samples, and `mean` is
+weighted by time: the energy of the seconds covered by samples at most
+MAX_ENERGY_GAP apart, split at the bucket boundaries, divided by those
+seconds. A bucket without such seconds falls back to the mean of its samples.
+
+streamRange() and retrieveRange() read a time range of raw samples or rollups
+through the ts indexes created at startup, either in batches of dicts or as
+columnar arrays.
 '''
 
+OVERFLOW_POLICIES = ("drop-oldest", "drop-newest", "block")
+ROLLUPS = {"1m": 60, "1h": 3600}  # suffix: bucket length in seconds
+MAX_ENERGY_GAP = 60.0  # seconds, longer gaps between samples count as no data
+
+# Clients shared by the MongoDb objects of one process, per connection string
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+INSERT_LATENCY = Histogram(
+    "coffeebot_mongodb_insert_seconds", "MongoDb insert_many latency per batch")
+BUFFERED = Gauge(
+    "coffeebot_mongodb_buffered_samples", "Samples waiting in the MongoDb write buffer")
+DROPPED = Counter(
+    "coffeebot_mongodb_dropped_samples_total", "Samples dropped because the write buffer was full")
+
+
+'''
+Aggregate of the samples that fell into one rollup bucket since the last flush
+'''
+
+
+class Rollup:
+    def __init__(self):
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.sum = 0.0
+        self.count = 0  # stored samples
+        self.energy = 0.0  # Wh
+        self.seconds = 0.0  # covered by the energy
+
+    def add(self, value: float) -> None:
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value
+        self.count += 1
 
-class MongoDb:
-    def __init__(self, url: str, db: str, collection: str):
-        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
-                            level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M:%S")
-        self.client = MongoClient(
-            host=url)
+    def addInterval(self, seconds: float, energy: float) -> None:
+        self.seconds += seconds
+        self.energy += energy
+
+    def merge(self, other) -> None:
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        self.count += other.count
+        self.energy += other.energy
+        self.seconds += other.seconds
+
+    '''
+    Update pipeline that folds this partial aggregate into the stored bucket
+    '''
+
+    def toUpdate(self) -> list[dict]:
+        fields = {
+            "sum": {"$add": [{"$ifNull": ["$sum", 0.0]}, self.sum]},
+            "count": {"$add": [{"$ifNull": ["$count", 0]}, self.count]},
+            "energy": {"$add": [{"$ifNull": ["$energy", 0.0]}, self.energy]},
+            "seconds": {"$add": [{"$ifNull": ["$seconds", 0.0]}, self.seconds]},
+        }
+        # Only the energy since the last sample may fall into this bucket
+        if (self.count):
+            fields["min"] = {"$min": ["$min", self.min]}
+            fields["max"] = {"$max": ["$max", self.max]}
+        return [
+            {"$set": fields},
+            {"$set": {"mean": {"$cond": [
+                {"$gt": ["$seconds", 0]},
+                {"$divide": [{"$multiply": ["$energy", 3600]}, "$seconds"]},
+                {"$cond": [{"$gt": ["$count", 0]}, {"$divide": ["$sum", "$count"]}, None]},
+            ]}}},
+        ]
+
+
+class MongoDb(StorageBackend):
+    def __init__(self, url: str, db: str, collection: str,
+                 batchSize: int = 1000, flushInterval: float = 300.0,
+                 maxBuffered: int = 50000, overflow: str = "drop-oldest",
+                 rawRetentionDays: float | None = None, shared: bool = False):
+        if (overflow not in OVERFLOW_POLICIES):
+            raise ValueError(f"Unknown overflow policy '{overflow}'")
+        self.shared = shared
+        if (shared):
+            with CLIENTS_LOCK:
+                if (url not in CLIENTS):
+                    CLIENTS[url] = MongoClient(host=url)
+                self.client = CLIENTS[url]
+        else:
+            self.client = MongoClient(
+                host=url)
         self.db = self.client[db]
         self.collection = self.db[collection]
+        self.rollupCollections = {
+            suffix: self.db[f"{collection}_{suffix}"] for suffix in ROLLUPS}
+        self.collectionName = collection
+        self.rawRetentionDays = rawRetentionDays
+        self.ready = False
+
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxBuffered = maxBuffered
+        self.overflow = overflow
+        self.buffer = deque()
+        self.dropped = 0
+        self.reportedDropped = 0
+        self.flushes = 0
+        self.flushTask = None
+        self.flushLock = asyncio.Lock()
+        self.flushRequested = asyncio.Event()
+        self.spaceAvailable = asyncio.Event()
+        self.rollups = {}  # (suffix, brewer, bucket start): Rollup
+        self.lastSample = {}  # brewer: (ts, power), for the energy integral
+
+    '''
+    Creates the time-series and rollup collections and their indexes. Runs
+    before the first write, so the server does not have to be up at startup.
+    '''
+
+    async def ensureReady(self) -> None:
+        if (not self.ready):
+            await asyncio.to_thread(self.setupCollections, self.collectionName)
+            self.ready = True
+
+    def setupCollections(self, collection: str) -> None:
+        expireAfterSeconds = None
+        ttlIndexed = False
+        if (self.rawRetentionDays):
+            expireAfterSeconds = int(self.rawRetentionDays * 86400)
+        options = {"timeseries": {"timeField": "ts", "metaField": "brewer",
+                                  "granularity": "seconds"}}
+        if (expireAfterSeconds):
+            options["expireAfterSeconds"] = expireAfterSeconds
+        try:
+            self.db.create_collection(collection, **options)
+            logger.info(f"Created time-series collection {collection}")
+        except CollectionInvalid:
+            info = self.db.command("listCollections", filter={"name": collection})
+            isTimeSeries = any(c.get("type") == "timeseries"
+                               for c in info["cursor"]["firstBatch"])
+            if (isTimeSeries):
+                self.db.command("collMod", collection,
+                                expireAfterSeconds=expireAfterSeconds or "off")
+            else:
+                logger.warning(
+                    f"{collection} is a regular collection, migrate it to a time-series collection to save space")
+                if (expireAfterSeconds):
+                    self.collection.create_index(
+                        "ts", name="ts_ttl", expireAfterSeconds=expireAfterSeconds)
+                    ttlIndexed = True
+        # Indexes for range reads
+        self.collection.create_index([("brewer", 1), ("ts", 1)], name="brewer_ts")
+        if (not ttlIndexed):
+            self.collection.create_index("ts", name="ts")
+        for rollupCollection in self.rollupCollections.values():
+            rollupCollection.create_index([("brewer", 1), ("ts", 1)], unique=True)
+
+    '''
+    Starts the background task that flushes the buffer
+    '''
 
-    async def store(self, value: float):
+    def start(self) -> None:
+        if (self.flushTask is None):
+            self.flushTask = asyncio.create_task(self.flushLoop())
+
+    '''
+    Stops the background task and writes all buffered samples
+    '''
+
+    async def close(self) -> None:
+        if (self.flushTask):
+            self.flushTask.cancel()
+            try:
+                await self.flushTask
+            except asyncio.CancelledError:
+                pass
+            self.flushTask = None
+        await self.flush()
+        if (self.buffer):
+            logger.error(
+                f"{len(self.buffer)} samples could not be written to MongoDb on shutdown")
+        if (not self.shared):
+            self.client.close()
+
+    '''
+    Buffers a sample for writing. Returns False if the sample was dropped.
+    '''
+
+    async def store(self, value: float, ts: datetime | None = None,
+                    brewer: str | None = None) -> bool:
         document = {
-            "ts": datetime.now(),
+            "ts": ts or datetime.now(),
             "power": value
         }
+        if (brewer):
+            document["brewer"] = brewer
+        self.accumulate(document["ts"], value, brewer)
+        while (len(self.buffer) >= self.maxBuffered):
+            if (self.overflow == "block"):
+                self.spaceAvailable.clear()
+                self.flushRequested.set()
+                await self.spaceAvailable.wait()
+            elif (self.overflow == "drop-newest"):
+                self.dropped += 1
+                DROPPED.inc()
+                return False
+            else:
+                self.buffer.popleft()
+                self.dropped += 1
+                DROPPED.inc()
+                break
+        self.buffer.append(document)
+        BUFFERED.set(len(self.buffer))
+        if (len(self.buffer) >= self.batchSize):
+            self.flushRequested.set()
+        return True
+
+    '''
+    Adds a sample to the rollup buckets it falls into
+    '''
+
+    def accumulate(self, ts: datetime, value: float, brewer: str | None) -> None:
+        epoch = ts.timestamp()
+        previous = self.lastSample.get(brewer)
+        self.lastSample[brewer] = (ts, value)
+        interval = None
+        if (previous):
+            seconds = (ts - previous[0]).total_seconds()
+            if (0.0 < seconds <= MAX_ENERGY_GAP):
+                interval = (epoch - seconds, previous[1])
+
+        for suffix, length in ROLLUPS.items():
+            self.rollup(suffix, brewer, ts, epoch, epoch).add(value)
+            if (interval is None):
+                continue
+            # Split the line from the previous sample at the bucket boundaries
+            start, startValue = interval
+            while (start < epoch):
+                end = min((start // length + 1) * length, epoch)
+                endValue = startValue + (value - startValue) * (end - start) / (epoch - start)
+                self.rollup(suffix, brewer, ts, epoch, start).addInterval(
+                    end - start, (startValue + endValue) / 2 * (end - start) / 3600)
+                start, startValue = end, endValue
+
+    '''
+    Returns the rollup of the bucket that holds the time `at` [seconds since
+    the epoch], with the bucket start derived from the sample at ts, epoch
+    '''
+
+    def rollup(self, suffix: str, brewer: str | None, ts: datetime, epoch: float,
+               at: float) -> Rollup:
+        length = ROLLUPS[suffix]
+        bucketStart = ts - timedelta(seconds=epoch - (at - at % length))
+        key = (suffix, brewer, bucketStart)
+        if (key not in self.rollups):
+            self.rollups[key] = Rollup()
+        return self.rollups[key]
+
+    '''
+    Folds the rollups accumulated since the last flush into the rollup collections
+    '''
+
+    async def flushRollups(self) -> None:
+        rollups, self.rollups = self.rollups, {}
+        if (not rollups):
+            return
+        for suffix in ROLLUPS:
+            keys = [key for key in rollups if key[0] == suffix]
+            operations = [
+                UpdateOne({"brewer": brewer, "ts": bucketStart},
+                          rollups[(suffix, brewer, bucketStart)].toUpdate(), upsert=True)
+                for (_, brewer, bucketStart) in keys]
+            try:
+                await asyncio.to_thread(
+                    self.rollupCollections[suffix].bulk_write, operations, ordered=False)
+            except Exception as e:
+                logger.error(f"Failed to store {suffix} rollups in MongoDb: {e}")
+                # Keep the partial aggregates for the next flush
+                for key in keys:
+                    if (key in self.rollups):
+                        rollups[key].merge(self.rollups[key])
+                    self.rollups[key] = rollups[key]
+
+    async def flushLoop(self) -> None:
+        while (True):
+            try:
+                await asyncio.wait_for(self.flushRequested.wait(),
+                                       timeout=self.flushInterval)
+            except asyncio.TimeoutError:
+                pass
+            self.flushRequested.clear()
+            await self.flush()
+
+    '''
+    Writes the buffered samples in batches of batchSize.
+    A failed batch is put back in the buffer and retried on the next flush.
+    '''
+
+    async def flush(self) -> None:
+        async with self.flushLock:
+            while (self.buffer):
+                count = min(self.batchSize, len(self.buffer))
+                batch = [self.buffer.popleft() for _ in range(count)]
+                try:
+                    await self.ensureReady()
+                    with INSERT_LATENCY.time():
+                        await asyncio.to_thread(
+                            self.collection.insert_many, batch, ordered=False)
+                    self.flushes += 1
+                except BulkWriteError as e:
+                    # The batch reached the server, retrying would only duplicate it
+                    logger.error(
+                        f"Failed to store part of a batch in MongoDb: {e.details.get('writeErrors', [])[:1]}")
+                except Exception as e:
+                    logger.error(f"Failed to store data in MongoDb: {e}")
+                    self.buffer.extendleft(reversed(batch))
+                    while (len(self.buffer) > self.maxBuffered):
+                        self.buffer.popleft()
+                        self.dropped += 1
+                        DROPPED.inc()
+                    return
+                finally:
+                    BUFFERED.set(len(self.buffer))
+                    self.spaceAvailable.set()
+            await self.flushRollups()
+            if (self.dropped > self.reportedDropped):
+                logger.warning(
+                    f"{self.dropped} samples dropped so far due to a full MongoDb buffer")
+                self.reportedDropped = self.dropped
+
+    '''
+    Writes a batch of {ts, power, brewer} documents and updates the rollups.
+    Raises if the batch did not reach the server, so the caller can retry it.
+    Documents whose "_id" is already stored are skipped and not added to the
+    rollups again. Time-series collections take neither unique indexes nor
+    upserts, so the stored ids are looked up first.
+    '''
+
+    async def insertBatch(self, documents: list[dict]) -> None:
+        await self.ensureReady()
+        ids = [document["_id"] for document in documents if "_id" in document]
+        if (ids):
+            query = {"ts": {"$gte": min(document["ts"] for document in documents),
+                            "$lte": max(document["ts"] for document in documents)},
+                     "_id": {"$in": ids}}
+            existing = await asyncio.to_thread(
+                lambda: {document["_id"] for document in self.collection.find(query, {"_id": 1})})
+            if (existing):
+                logger.info(f"Skipped {len(existing)} samples already stored in MongoDb")
+                documents = [document for document in documents
+                             if document.get("_id") not in existing]
+            if (not documents):
+                return
+        failed = set()
         try:
-            result = self.collection.insert_one(document)
-            return result.inserted_id
-        except Exception as e:
-            logging.error(f"Failed to store data in MongoDb: {e}")
-            return None
+            with INSERT_LATENCY.time():
+                await asyncio.to_thread(
+                    self.collection.insert_many, documents, ordered=False)
+        except BulkWriteError as e:
+            # The batch reached the server, retrying would only duplicate it
+            errors = e.details.get("writeErrors", [])
+            failed = {error["index"] for error in errors}
+            logger.error(f"Failed to store part of a batch in MongoDb: {errors[:1]}")
+        self.flushes += 1
+        for index, document in enumerate(documents):
+            if (index not in failed):
+                self.accumulate(document["ts"], document["power"], document.get("brewer"))
+        await self.flushRollups()
+
+    async def drop(self) -> None:
+        await asyncio.to_thread(self.collection.drop)
+        for rollupCollection in self.rollupCollections.values():
+            await asyncio.to_thread(rollupCollection.drop)
+        self.ready = False
 
     async def retrieve(self, document_id):
         try:
             document = self.collection.find_one({'_id': document_id})
             return {"ts": document["ts"], "power": document["power"]}
         except Exception as e:
-            logging.error(f"Failed to retrieve data from MongoDb: {e}")
+            logger.error(f"Failed to retrieve data from MongoDb: {e}")
             return {}
+
+    '''
+    Streams the samples with start <= ts < end in batches of up to batchSize
+    dicts with "ts" and "power". With rollup set to "1m" or "1h" the rollup
+    buckets are read instead, with the bucket mean as "power" plus "min",
+    "max" and "energy".
+    '''
+
+    async def streamRange(self, start: datetime, end: datetime,
+                          brewer: str | None = None, batchSize: int = 5000,
+                          rollup: str | None = None):
+        query = {"ts": {"$gte": start, "$lt": end}}
+        if (brewer):
+            query["brewer"] = brewer
+        if (rollup):
+            collection = self.rollupCollections[rollup]
+            projection = {"_id": 0, "ts": 1, "power": "$mean",
+                          "min": 1, "max": 1, "energy": 1}
+        else:
+            collection = self.collection
+            projection = {"_id": 0, "ts": 1, "power": 1}
+        cursor = collection.find(query, projection, batch_size=batchSize).sort("ts", 1)
+        try:
+            while (True):
+                batch = await asyncio.to_thread(
+                    lambda: list(islice(cursor, batchSize)))
+                if (not batch):
+                    return
+                yield batch
+        finally:
+            cursor.close()
+
+    '''
+    Returns the samples with start <= ts < end as two columns: timestamps in
+    seconds since the epoch and power [Watt], both as arrays of doubles.
+    Raises if the read fails, rather than returning a truncated range.
+    '''
+
+    async def retrieveRange(self, start: datetime, end: datetime,
+                            brewer: str | None = None, batchSize: int = 5000,
+                            rollup: str | None = None) -> tuple[array, array]:
+        timestamps = array("d")
+        powers = array("d")
+        async for batch in self.streamRange(start, end, brewer, batchSize, rollup):
+            timestamps.extend(document["ts"].timestamp() for document in batch)
+            powers.extend(float(document["power"]) for document in batch)
+        return timestamps, powers
+
+    async def brewers(self, start: datetime, end: datetime) -> list[str]:
+        names = await asyncio.to_thread(
+            self.collection.distinct, "brewer", {"ts": {"$gte": start, "$lt": end}})
+        return sorted(name for name in names if name)
@@ -0,0 +1,201 @@
+import re
+import asyncio
+import logging
+import threading
+import mysql.connector
+from mysql.connector import errorcode, pooling
+from datetime import datetime
+from array import array
+
+from db.backend import StorageBackend
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+'''
+MySql class responsible for storing and retrieving data from MySQL
+
+Samples are rows of (ts, brewer, watts) with ts in seconds since the epoch.
+Connections come from a pool of poolSize connections, and every query runs in
+a worker thread so the event loop keeps sampling. Batches are written with
+executemany, which the connector sends as multi-row INSERT statements. The ts
+and (brewer, ts) indexes serve range reads. Tables created by the old
+mysql-db.py, with only ts and watts, get the brewer column and the indexes
+added at startup.
+'''
+
+# Pools shared by the MySql objects of one process, per server, user and database
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+INSERT_LATENCY = Histogram(
+    "coffeebot_mysql_insert_seconds", "MySQL executemany latency per batch")
+
+
+class MySql(StorageBackend):
+    def __init__(self, host: str, user: str, password: str, database: str,
+                 table: str, sslCa: str | None = None, poolSize: int = 4,
+                 shared: bool = False):
+        if (not re.fullmatch(r"\w+", table or "")):
+            raise ValueError(f"Invalid MySQL table name '{table}'")
+        self.table = table
+        config = {
+            "host": host,
+            "user": user,
+            "password": password,
+            "database": database,
+        }
+        if (sslCa):
+            config["client_flags"] = [mysql.connector.ClientFlag.SSL]
+            config["ssl_ca"] = sslCa
+        key = (host, user, database)
+        try:
+            with POOLS_LOCK:
+                if (shared and key in POOLS):
+                    self.pool, self.connections = POOLS[key]
+                else:
+                    self.pool = pooling.MySQLConnectionPool(
+                        pool_name=f"coffeebot_{len(POOLS)}_{table}", pool_size=poolSize, **config)
+                    # The pool raises instead of waiting when it is exhausted
+                    self.connections = asyncio.Semaphore(poolSize)
+                    if (shared):
+                        POOLS[key] = (self.pool, self.connections)
+        except mysql.connector.Error as err:
+            if (err.errno == errorcode.ER_ACCESS_DENIED_ERROR):
+                logger.error("Something is wrong with the MySQL user name or password")
+            elif (err.errno == errorcode.ER_BAD_DB_ERROR):
+                logger.error(f"MySQL database {database} does not exist")
+            raise
+        self.setupTable()
+
+    '''
+    Creates the table and its indexes, and upgrades tables of the old layout
+    '''
+
+    def setupTable(self) -> None:
+        connection = self.pool.get_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "ts DOUBLE NOT NULL DEFAULT 0, brewer VARCHAR(64) NULL, "
+                "watts DOUBLE NOT NULL DEFAULT 0.0, "
+                "INDEX ts (ts), INDEX brewer_ts (brewer, ts))")
+            cursor.execute(f"SHOW COLUMNS FROM {self.table}")
+            columns = {row[0] for row in cursor.fetchall()}
+            if ("brewer" not in columns):
+                cursor.execute(f"ALTER TABLE {self.table} ADD COLUMN brewer VARCHAR(64) NULL")
+                logger.info(f"Added the brewer column to {self.table}")
+            cursor.execute(f"SHOW INDEX FROM {self.table}")
+            indexes = {row[2] for row in cursor.fetchall()}
+            if ("ts" not in indexes):
+                cursor.execute(f"CREATE INDEX ts ON {self.table} (ts)")
+            if ("brewer_ts" not in indexes):
+                cursor.execute(f"CREATE INDEX brewer_ts ON {self.table} (brewer, ts)")
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+
+    '''
+    Runs function(cursor) on a pooled connection in a worker thread and commits
+    '''
+
+    async def run(self, function):
+        def work():
+            connection = self.pool.get_connection()
+            try:
+                cursor = connection.cursor()
+                try:
+                    result = function(cursor)
+                    connection.commit()
+                    return result
+                finally:
+                    cursor.close()
+            finally:
+                # Returns the connection to the pool
+                connection.close()
+
+        async with self.connections:
+            return await asyncio.to_thread(work)
+
+    '''
+    Writes one sample. coffee-bot.py writes through db/spool.py, which hands
+    over whole batches with insertBatch().
+    '''
+
+    async def store(self, value: float, ts: datetime | None = None,
+                    brewer: str | None = None) -> bool:
+        document = {"ts": ts or datetime.now(), "power": value}
+        if (brewer):
+            document["brewer"] = brewer
+        try:
+            await self.insertBatch([document])
+        except Exception as e:
+            logger.error(f"Failed to store data in MySQL: {e}")
+            return False
+        return True
+
+    '''
+    Writes a batch of {ts, power, brewer} documents. A batch with "_id"s is a
+    retry-safe batch from the spool, and its rows that are already stored, i.e.
+    with the same brewer and ts, are skipped.
+    '''
+
+    async def insertBatch(self, documents: list[dict]) -> None:
+        rows = [(document["ts"].timestamp(), document.get("brewer"), document["power"])
+                for document in documents]
+        statement = f"INSERT INTO {self.table} (ts, brewer, watts) VALUES (%s, %s, %s)"
+        deduplicate = any("_id" in document for document in documents)
+        query = f"SELECT ts, brewer FROM {self.table} WHERE ts >= %s AND ts <= %s"
+
+        def write(cursor):
+            batch = rows
+            if (deduplicate and batch):
+                cursor.execute(query, (min(row[0] for row in batch), max(row[0] for row in batch)))
+                existing = {(float(ts), brewer) for ts, brewer in cursor.fetchall()}
+                batch = [row for row in batch if (row[0], row[1]) not in existing]
+                if (len(batch) < len(rows)):
+                    logger.info(f"Skipped {len(rows) - len(batch)} samples already stored in MySQL")
+            if (batch):
+                cursor.executemany(statement, batch)
+
+        with INSERT_LATENCY.time():
+            await self.run(write)
+
+    async def retrieveRange(self, start: datetime, end: datetime,
+                            brewer: str | None = None,
+                            batchSize: int = 5000) -> tuple[array, array]:
+        query = f"SELECT ts, watts FROM {self.table} WHERE ts >= %s AND ts < %s"
+        parameters = [start.timestamp(), end.timestamp()]
+        if (brewer):
+            query += " AND brewer = %s"
+            parameters.append(brewer)
+        query += " ORDER BY ts"
+
+        def read(cursor):
+            timestamps = array("d")
+            powers = array("d")
+            cursor.execute(query, parameters)
+            while (True):
+                rows = cursor.fetchmany(batchSize)
+                if (not rows):
+                    return timestamps, powers
+                timestamps.extend(float(row[0]) for row in rows)
+                powers.extend(float(row[1]) for row in rows)
+
+        return await self.run(read)
+
+    async def brewers(self, start: datetime, end: datetime) -> list[str]:
+        query = (f"SELECT DISTINCT brewer FROM {self.table} "
+                 "WHERE ts >= %s AND ts < %s AND brewer IS NOT NULL")
+
+        def read(cursor):
+            cursor.execute(query, [start.timestamp(), end.timestamp()])
+            return sorted(row[0] for row in cursor.fetchall() if row[0])
+
+        return await self.run(read)
+
+    async def drop(self) -> None:
+        await self.run(lambda cursor: cursor.execute(f"DROP TABLE IF EXISTS {self.table}"))
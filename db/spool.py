@@ -0,0 +1,220 @@
+import time
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime
+from metrics import Counter, Gauge
+from db.compression import SwingingDoor
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Spool class responsible for keeping samples on disk until they are stored
+
+store() appends every sample to an SQLite database in WAL mode, so sampling
+never waits for the network and nothing is lost while the database is
+unreachable or the bot restarts. A background task started with start()
+replicates the spooled samples to the storage backend in batches of
+batchSize, oldest first, whenever batchSize samples are waiting or
+replicateInterval seconds have passed. The id of the last replicated sample
+is the checkpoint; it is committed together with the removal of the
+replicated rows, so replication resumes where it left off. A crash after
+the backend stored a batch but before the checkpoint was committed sends the
+batch again, so every sample carries an "_id" derived from its brewer and
+timestamp, and the backends skip samples they already hold.
+
+With a `tolerance`, each brewer's samples pass through swinging door
+compression (see db/compression.py) before they are spooled, so only samples
+that depart from the trend by more than tolerance Watt are stored.
+
+The backend (see db/backend.py) is created by the `connect` function on first
+use and again after a failure, with backoff, so the database may be down at
+startup.
+'''
+
+RETRY_DELAY = 5.0  # seconds, doubled after every failed replication
+MAX_RETRY_DELAY = 300.0
+
+SPOOLED = Gauge(
+    "coffeebot_spool_samples", "Samples in the spool waiting for replication")
+REPLICATED = Counter(
+    "coffeebot_spool_replicated_samples_total", "Samples replicated from the spool to the database")
+REPLICATION_FAILURES = Counter(
+    "coffeebot_spool_replication_failures_total", "Failed replication attempts")
+COMPRESSED = Counter(
+    "coffeebot_spool_compressed_samples_total", "Samples not stored because they are on the trend")
+
+
+class Spool:
+    def __init__(self, path: str, connect, batchSize: int = 1000,
+                 replicateInterval: float = 300.0, tolerance: float | None = None,
+                 maxGap: float = 60.0):
+        self.path = path
+        self.connect = connect
+        self.db = None
+        self.batchSize = batchSize
+        self.replicateInterval = replicateInterval
+        self.replicateTask = None
+        self.replicateRequested = asyncio.Event()
+        self.replicated = 0
+        self.tolerance = tolerance
+        self.maxGap = maxGap
+        self.doors = {}  # brewer: SwingingDoor
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this only syncs at checkpoints, a power cut may lose the
+        # last samples but never corrupts the spool
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                "id INTEGER PRIMARY KEY, ts REAL NOT NULL, brewer TEXT, power REAL NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint (name TEXT PRIMARY KEY, lastId INTEGER NOT NULL)")
+        row = self.connection.execute(
+            "SELECT lastId FROM checkpoint WHERE name = 'backend'").fetchone()
+        self.checkpoint = row[0] if row else 0
+        self.pending = self.connection.execute(
+            "SELECT COUNT(*) FROM samples WHERE id > ?", (self.checkpoint,)).fetchone()[0]
+        SPOOLED.set(self.pending)
+        if (self.pending):
+            logger.info(f"{self.pending} spooled samples waiting for replication")
+
+    '''
+    Starts the background task that replicates the spool
+    '''
+
+    def start(self) -> None:
+        if (self.replicateTask is None):
+            self.replicateTask = asyncio.create_task(self.replicateLoop())
+
+    '''
+    Stops replication, makes a last attempt to replicate everything spooled and
+    closes the spool. Samples that could not be replicated stay on disk.
+    '''
+
+    async def close(self) -> None:
+        if (self.replicateTask):
+            self.replicateTask.cancel()
+            try:
+                await self.replicateTask
+            except asyncio.CancelledError:
+                pass
+            self.replicateTask = None
+        # Store the samples held back by compression
+        for brewer, door in self.doors.items():
+            self.insert(brewer, door.flush())
+        try:
+            while (await self.replicate()):
+                pass
+        except Exception as e:
+            logger.error(f"Failed to replicate the spool on shutdown: {e}")
+        if (self.pending):
+            logger.warning(f"{self.pending} samples stay in {self.path} until the next start")
+        self.connection.close()
+        await self.disconnect()
+
+    async def store(self, value: float, ts: datetime | None = None,
+                    brewer: str | None = None) -> bool:
+        ts = ts.timestamp() if ts else time.time()
+        samples = [(ts, value)]
+        if (self.tolerance is not None):
+            door = self.doors.get(brewer)
+            if (door is None):
+                door = self.doors[brewer] = SwingingDoor(self.tolerance, self.maxGap)
+            dropped = door.dropped
+            samples = door.add(ts, value)
+            if (door.dropped > dropped):
+                COMPRESSED.inc(door.dropped - dropped)
+        self.insert(brewer, samples)
+        if (self.pending >= self.batchSize):
+            self.replicateRequested.set()
+        return True
+
+    def insert(self, brewer: str | None, samples: list[tuple[float, float]]) -> None:
+        if (not samples):
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO samples (ts, brewer, power) VALUES (?, ?, ?)",
+                [(ts, brewer, value) for ts, value in samples])
+        self.pending += len(samples)
+        SPOOLED.set(self.pending)
+
+    async def replicateLoop(self) -> None:
+        delay = RETRY_DELAY
+        while (True):
+            try:
+                await asyncio.wait_for(self.replicateRequested.wait(),
+                                       timeout=self.replicateInterval)
+            except asyncio.TimeoutError:
+                pass
+            self.replicateRequested.clear()
+            try:
+                while (await self.replicate()):
+                    pass
+                delay = RETRY_DELAY
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                REPLICATION_FAILURES.inc()
+                logger.error(f"Failed to replicate the spool, "
+                              f"{self.pending} samples waiting, retrying in {delay:.0f} s: {e}")
+                await self.disconnect()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                self.replicateRequested.set()
+
+    async def disconnect(self) -> None:
+        db, self.db = self.db, None
+        if (db):
+            try:
+                await db.close()
+            except Exception as e:
+                logger.debug(f"Failed to close the storage backend: {e}")
+
+    '''
+    Replicates the oldest batch of spooled samples and advances the checkpoint.
+    Returns False when there was nothing to replicate.
+    '''
+
+    async def replicate(self) -> bool:
+        rows = self.connection.execute(
+            "SELECT id, ts, brewer, power FROM samples WHERE id > ? ORDER BY id LIMIT ?",
+            (self.checkpoint, self.batchSize)).fetchall()
+        if (not rows):
+            return False
+        if (self.db is None):
+            self.db = await asyncio.to_thread(self.connect)
+        documents = []
+        for _, ts, brewer, power in rows:
+            document = {"ts": datetime.fromtimestamp(ts), "power": power}
+            if (brewer):
+                document["brewer"] = brewer
+            document["_id"] = sampleId(brewer, ts)
+            documents.append(document)
+        await self.db.insertBatch(documents)
+
+        lastId = rows[-1][0]
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO checkpoint (name, lastId) VALUES ('backend', ?) "
+                "ON CONFLICT (name) DO UPDATE SET lastId = excluded.lastId", (lastId,))
+            self.connection.execute("DELETE FROM samples WHERE id <= ?", (lastId,))
+        self.checkpoint = lastId
+        self.pending = max(self.pending - len(rows), 0)
+        self.replicated += len(rows)
+        REPLICATED.inc(len(rows))
+        SPOOLED.set(self.pending)
+        return True
+
+
+'''
+Returns the id of a sample, the same every time the sample is replicated
+'''
+
+
+def sampleId(brewer: str | None, ts: float) -> str:
+    return f"{brewer or ''}@{ts!r}"
@@ -0,0 +1,248 @@
+import os
+import json
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Rolling statistics over the last `size` samples, kept in a ring buffer.
+Every push updates the mean, variance and least squares slope in O(1).
+'''
+
+
+class RollingStats:
+    def __init__(self, size: int):
+        self.size = size
+        self.values = [0.0] * size
+        self.start = 0  # index of the oldest value
+        self.count = 0
+        self.sum = 0.0
+        self.sumSquares = 0.0
+        self.sumIndexed = 0.0  # sum of i * y with i = 0 for the oldest value
+        self.pushes = 0
+
+    def push(self, value: float) -> None:
+        if (self.count < self.size):
+            self.values[(self.start + self.count) % self.size] = value
+            self.sumIndexed += self.count * value
+            self.count += 1
+        else:
+            oldest = self.values[self.start]
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.size
+            # Every remaining value moves one index down
+            self.sumIndexed += -(self.sum - oldest) + (self.size - 1) * value
+            self.sum -= oldest
+            self.sumSquares -= oldest * oldest
+        self.sum += value
+        self.sumSquares += value * value
+        self.pushes += 1
+        # Recompute now and then so rounding errors don't pile up
+        if (self.pushes % (self.size * 1000) == 0):
+            self.recompute()
+
+    def recompute(self) -> None:
+        ordered = [self.values[(self.start + i) % self.size] for i in range(self.count)]
+        self.sum = sum(ordered)
+        self.sumSquares = sum(value * value for value in ordered)
+        self.sumIndexed = sum(i * value for i, value in enumerate(ordered))
+
+    def full(self) -> bool:
+        return self.count == self.size
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def variance(self) -> float:
+        if (self.count < 2):
+            return 0.0
+        mean = self.mean()
+        return max(self.sumSquares / self.count - mean * mean, 0.0)
+
+    def std(self) -> float:
+        return math.sqrt(self.variance())
+
+    '''
+    Least squares slope per sample
+    '''
+
+    def slope(self) -> float:
+        n = self.count
+        if (n < 2):
+            return 0.0
+        sumX = n * (n - 1) / 2
+        sumXSquares = (n - 1) * n * (2 * n - 1) / 6
+        return (n * self.sumIndexed - sumX * self.sum) / (n * sumXSquares - sumX * sumX)
+
+
+OFF = "off"
+IDLE = "idle"
+HEATING = "heating"
+BREWING = "brewing"
+DONE = "done"
+
+
+'''
+Streaming brewer state detector, fed one power sample [Watt] at a time.
+
+The defaults are calibrated for a Moccamaster KBG744 AO-B:
+    off       power <= offMax
+    idle      offMax < power < heatMin, standby draw, treated like off
+    heating   heatMin <= power <= heatMax, the hot plates keep old coffee warm
+    brewing   power >= brewOn, until it drops below brewOff
+    done      the hot plates keep freshly brewed coffee warm
+A brew start is reported on the first sample above brewOn. Dropping to the hot
+plate band or to off has to hold for `confirmSamples` samples, and for
+confirmSamples * interval seconds when sampled faster, with a standard
+deviation within `tolerance` (doubled above 2000 W) before it is reported.
+Power between heatMax and brewOn never changes the state on its own.
+'''
+
+
+class Detector:
+    def __init__(self, offMax: float = 0.5, heatMin: float = 1.0,
+                 heatMax: float = 300.0, brewOn: float = 1000.0,
+                 brewOff: float = 600.0, tolerance: float = 40.0,
+                 confirmSamples: int = 2, interval: float = 5.0):
+        self.offMax = offMax
+        self.heatMin = heatMin
+        self.heatMax = heatMax
+        self.brewOn = brewOn
+        self.brewOff = brewOff
+        self.tolerance = tolerance
+        self.confirmSamples = confirmSamples
+        self.interval = interval
+        self.stats = RollingStats(confirmSamples)
+        self.state = OFF
+        self.candidate = None
+        self.candidateCount = 0
+        self.candidateSeconds = 0.0
+        self.power = None
+
+    def band(self, power: float) -> str | None:
+        if (power <= self.offMax):
+            return OFF
+        if (power < self.heatMin):
+            return IDLE
+        if (power <= self.heatMax):
+            return HEATING
+        return None
+
+    '''
+    Returns the power trend in Watt per second
+    '''
+
+    def slope(self) -> float:
+        return self.stats.slope() / self.interval
+
+    '''
+    Feeds one sample, taken `seconds` after the previous one (default
+    interval). Returns the new state if it changed, None otherwise.
+    '''
+
+    def update(self, power: float, seconds: float | None = None) -> str | None:
+        self.stats.push(power)
+        self.power = power
+
+        # A brew start is unambiguous, report it right away
+        if (power >= self.brewOn):
+            self.candidate = None
+            return self.enter(BREWING)
+        if (self.state == BREWING and power >= self.brewOff):
+            self.candidate = None
+            return None
+
+        band = self.band(power)
+        if (band is None):
+            self.candidate = None
+            return None
+        if (band != self.candidate):
+            self.candidate = band
+            self.candidateCount = 0
+            self.candidateSeconds = 0.0
+        self.candidateCount += 1
+        self.candidateSeconds += self.interval if seconds is None else seconds
+        tolerance = self.tolerance * (2 if self.stats.mean() > 2000.0 else 1)
+        if (self.candidateCount < self.confirmSamples or self.stats.std() > tolerance
+                or not self.confirmed()):
+            return None
+        return self.enter(self.target(band))
+
+    def confirmed(self) -> bool:
+        # Allow for rounding in the sum of the intervals
+        return self.candidateSeconds >= self.confirmSamples * self.interval - 1e-6
+
+    '''
+    Returns the state a confirmed power band leads to
+    '''
+
+    def target(self, band: str) -> str:
+        if (band == HEATING):
+            if (self.state == BREWING):
+                return DONE
+            if (self.state in (OFF, IDLE)):
+                return HEATING
+            return self.state
+        if (band == OFF):
+            return OFF
+        # Standby draw after heating or brewing means the brewer was switched off
+        return IDLE if self.state in (OFF, IDLE) else OFF
+
+    '''
+    True while power is between the hot plate band and brewOn, i.e. ramping
+    up to or down from a brew, and while a state change waits to be
+    confirmed, i.e. when sampling fast pays off. A steady brew is not.
+    '''
+
+    def transitional(self) -> bool:
+        if (self.power is not None and self.heatMax < self.power < self.brewOn):
+            return True
+        if (self.candidate is None or self.confirmed()):
+            return False
+        target = self.target(self.candidate)
+        # Flickering between off and standby draw is not worth sampling fast
+        return target != self.state and not (target in (OFF, IDLE) and self.state in (OFF, IDLE))
+
+    def enter(self, state: str) -> str | None:
+        if (state == self.state):
+            return None
+        logger.debug(f"Detector {self.state} -> {state}")
+        self.state = state
+        return state
+
+
+PROFILE_FIELDS = ("offMax", "heatMin", "heatMax", "brewOn", "brewOff",
+                  "tolerance", "confirmSamples")
+
+
+'''
+Returns the path of the calibration profile of a brewer, see calibrate.py
+'''
+
+
+def profilePath(name: str) -> str:
+    directory = os.getenv("BREWER_PROFILES") or "profiles"
+    fileName = "".join(c if c.isalnum() or c in "-_" else "_" for c in name) or "default"
+    return os.path.join(directory, f"{fileName}.json")
+
+
+'''
+Loads the detector thresholds calibrated for a brewer.
+Returns an empty dict, i.e. the KBG744 defaults, if there is no profile.
+'''
+
+
+def loadProfile(name: str) -> dict:
+    path = profilePath(name)
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Could not load brewer profile {path}: {e}")
+        return {}
+    logger.info(f"Loaded brewer profile {path}")
+    return {key: profile[key] for key in PROFILE_FIELDS if key in profile}
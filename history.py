@@ -0,0 +1,152 @@
+import json
+import time
+from array import array
+from bisect import bisect_left
+from urllib.parse import parse_qs
+
+MAX_CACHED = 64  # cached responses, one per distinct query
+
+
+'''
+Power samples of a brewer from the last `maxAge` seconds
+
+The brewer is sampled at an adaptive interval, so the buffer keeps samples by
+age rather than by count. Timestamps are kept as unsigned 32-bit seconds and
+power as 32-bit floats, 8 bytes per sample: a day of samples every 5 seconds
+takes 135 kB per brewer. Samples that are too old are skipped and removed in
+one go once they make up half the arrays. `version` counts the appended
+samples and changes whenever the contents do.
+'''
+
+
+class RecentSamples:
+    def __init__(self, maxAge: float):
+        self.maxAge = maxAge
+        self.ts = array("I")
+        self.power = array("f")
+        self.start = 0  # index of the oldest sample kept
+        self.version = 0
+
+    def append(self, ts: float, power: float) -> None:
+        self.ts.append(int(ts))
+        self.power.append(power)
+        self.version += 1
+        cutoff = ts - self.maxAge
+        while (self.ts[self.start] < cutoff):
+            self.start += 1
+        if (self.start > len(self.ts) // 2):
+            del self.ts[:self.start]
+            del self.power[:self.start]
+            self.start = 0
+
+    '''
+    Returns the samples with ts >= since, oldest first, as (ts, power) arrays
+    '''
+
+    def window(self, since: float = 0.0) -> tuple[array, array]:
+        first = bisect_left(self.ts, since, lo=self.start)
+        return self.ts[first:], self.power[first:]
+
+
+'''
+True if an If-None-Match header lists the entity tag or is "*". Tags are
+compared whole and, as If-None-Match asks for, weakly, i.e. ignoring "W/".
+'''
+
+
+def etagMatches(etag: str, header: str) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    if ("*" in tags):
+        return True
+    return any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags if tag)
+
+
+'''
+HTTP API answering "is there coffee?" from memory
+
+GET /status returns the state of every brewer and the time since its last
+brew finished. GET /history?brewer=<name>&minutes=<n> returns the recent
+samples of one brewer as ts and power columns. Responses carry an ETag built
+from the sample versions and, for /status, the brewer state versions, since
+repeated push readings change the state without adding samples. They are
+cached until a version changes, and a matching If-None-Match is answered with 304, so dashboards can poll as often
+as they like without touching the plugs or the database.
+'''
+
+
+class StatusApi:
+    def __init__(self, brewers: list = ()):
+        self.brewers = {}
+        self.cache = {}  # (path, query): (version, etag, body)
+        self.add(brewers)
+
+    '''
+    Adds brewers, by key: the name, prefixed with "<site>/" for multi-site
+    '''
+
+    def add(self, brewers: list) -> None:
+        for brewer in brewers:
+            self.brewers[brewer.key] = brewer
+        self.cache.clear()
+
+    def register(self, server) -> None:
+        server.addRoute("/status", self.status)
+        server.addRoute("/history", self.history)
+
+    def version(self) -> int:
+        return sum(brewer.history.version + brewer.version for brewer in self.brewers.values())
+
+    '''
+    Answers from the cache or renders the body with render() and caches it
+    '''
+
+    def respond(self, key: tuple, version: int, headers: dict, render):
+        cached = self.cache.get(key)
+        if (cached is None or cached[0] != version):
+            body = json.dumps(render(), separators=(",", ":")).encode()
+            cached = (version, f'"{version:x}-{len(body):x}"', body)
+            self.cache[key] = cached
+        _, etag, body = cached
+        extra = {"ETag": etag, "Cache-Control": "no-cache"}
+        if (etagMatches(etag, headers.get("if-none-match", ""))):
+            return 304, "application/json", b"", extra
+        return 200, "application/json", body, extra
+
+    def status(self, headers: dict, query: str):
+        def render():
+            now = time.time()
+            brewers = []
+            for name, brewer in self.brewers.items():
+                finished = brewer.lastBrewFinished
+                brewers.append({
+                    "name": name,
+                    "state": brewer.detector.state,
+                    "power": brewer.lastPower,
+                    "coffeeDone": brewer.state["coffeeDone"],
+                    "lastBrewFinished": round(finished) if finished else None,
+                    "secondsSinceBrew": round(now - finished) if finished else None,
+                })
+            return {"ts": round(now), "brewers": brewers}
+
+        return self.respond(("/status",), self.version(), headers, render)
+
+    def history(self, headers: dict, query: str):
+        parameters = parse_qs(query)
+        name = parameters.get("brewer", [next(iter(self.brewers), "")])[0]
+        brewer = self.brewers.get(name)
+        if (brewer is None):
+            return 404, "text/plain", b"Unknown brewer\n", {}
+        try:
+            minutes = float(parameters.get("minutes", ["0"])[0])
+        except ValueError:
+            return 400, "text/plain", b"minutes must be a number\n", {}
+
+        def render():
+            since = time.time() - minutes * 60 if minutes > 0 else 0.0
+            ts, power = brewer.history.window(since)
+            return {"brewer": name, "ts": ts.tolist(),
+                    "power": [round(value, 1) for value in power]}
+
+        if (len(self.cache) > MAX_CACHED):
+            self.cache.clear()
+        return self.respond(("/history", query), brewer.history.version, headers, render)
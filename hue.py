@@ -1,30 +1,78 @@
 import os
+import time
+import asyncio
 import logging
+import httpx
 import requests
+from ratelimiter import RateLimiter
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+# The bridge handles about 10 light commands or 1 group command per second
+LIGHT_COMMANDS_PER_SECOND = 10
+GROUP_COMMANDS_PER_SECOND = 1
+REQUEST_TIMEOUT = 5.0  # seconds
+STATE_CACHE_TTL = 300.0  # seconds before a cached light state is no longer trusted
+NATIVE_EFFECT_DURATION = 3600  # seconds a bridge-side effect runs unless stopped
+
+REQUEST_LATENCY = Histogram(
+    "coffeebot_hue_request_seconds", "Hue bridge request latency", ["resource"])
+UPDATE_LATENCY = Histogram(
+    "coffeebot_hue_update_seconds", "Time until all lights had changed")
+SKIPPED_COMMANDS = Counter(
+    "coffeebot_hue_skipped_commands_total", "Hue commands skipped because the lights already had the state")
+
+
+'''
+Hue class responsible for the lights of one bridge. The bridge, group and
+username default to HUE_IP, HUE_GROUP and the hue_username file; a username
+passed in, e.g. from a multi-site config, skips the authorization prompt.
+Without a terminal, e.g. in the worker processes of a multi-site config, the
+username has to be passed in: the shared hue_username file belongs to one
+bridge only, and nobody could answer the prompt.
+'''
 
 
 class Hue:
-    def __init__(self):
-        logging.basicConfig(
-            format="%(asctime)s %(levelname)s: %(message)s",
-            level=logging.DEBUG,
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
+    def __init__(self, bridgeIp: str | None = None, groupName: str | None = None,
+                 username: str | None = None, interactive: bool = True):
         try:
-            self.bridgeIp = os.getenv("HUE_IP")
+            self.bridgeIp = bridgeIp or os.getenv("HUE_IP")
             self.url = f"http://{self.bridgeIp}/api"
             self.urlV2 = f"http://{self.bridgeIp}/clip/v2"
         except KeyError:
-            logging.error("Could not parse HUE_IP in the file .env")
+            logger.error("Could not parse HUE_IP in the file .env")
             quit(1)
 
+        # Room or zone to control, all lights on the bridge if not set
+        self.groupName = (os.getenv("HUE_GROUP") if groupName is None else groupName) or ""
         self.lights = []
-        self.username = ""
-        self.loadUsername()
+        self.groupedLight = None
+        self.lastUpdateLatency = None  # seconds until all lights had changed
+        # Last applied state per light: {"on": ..., "dimming": ..., "color": ...}
+        self.lightStates = {}
+        self.skippedCommands = 0
+        # Signals every light supports natively, e.g. "on_off", "on_off_color"
+        self.signals = set()
+        self.effect = None  # name of the running effect
+        self.effectTask = None
+        self.nativeEffect = False
+        self.session = None
+        self.lightLimiter = RateLimiter(LIGHT_COMMANDS_PER_SECOND,
+                                        burst=LIGHT_COMMANDS_PER_SECOND)
+        self.groupLimiter = RateLimiter(GROUP_COMMANDS_PER_SECOND)
+        self.username = username or ""
+        if (self.username == "" and not interactive):
+            raise ValueError("No Hue username given for the bridge at "
+                             f"{self.bridgeIp}, set HUE_USERNAME")
+        if (self.username == ""):
+            self.loadUsername()
         if (self.username == ""):
-            logging.info("Waiting for Hue authorization...")
+            logger.info("Waiting for Hue authorization...")
             self.authorize()
-            logging.info("---> Hue Authorization complete!")
+            logger.info("---> Hue Authorization complete!")
 
     def saveUsername(self, username):
         try:
@@ -32,7 +80,7 @@ class Hue:
             f.write(username)
             f.close()
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
 
     def loadUsername(self):
         try:
@@ -40,7 +88,7 @@ class Hue:
             self.username = f.readline()
             f.close()
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             self.username = ""
             return
 
@@ -50,10 +98,10 @@ class Hue:
             hueResponse = requests.post(self.url, json={"devicetype": "coffeebot"})
             # Need to generate username
             if (hueResponse.json()[0]["error"]["type"] == 101):
-                logging.info("\tPlease press the link button on the HUE Bridge.")
+                logger.info("\tPlease press the link button on the HUE Bridge.")
                 user_input = input("Have you pressed it? [y/n] ")
                 if (not user_input == "y"):
-                    logging.info("\tHue authentication cancelled. Exiting.")
+                    logger.info("\tHue authentication cancelled. Exiting.")
                     quit(0)
                 else:
                     hueResponse = requests.post(
@@ -67,8 +115,8 @@ class Hue:
                 self.username = username
                 self.saveUsername(username)
         except Exception as e:
-            logging.error("Error during Hue authentication.")
-            logging.error("Exception: ", e)
+            logger.error("Error during Hue authentication.")
+            logger.error("Exception: ", e)
             quit(1)
 
     def getLights(self):
@@ -78,62 +126,201 @@ class Hue:
         try:
             hueResponse = requests.get(f"{self.url}/{self.username}/lights/")
             if (not hueResponse.ok):
-                logging.warning("Unable to get Hue lights.")
+                logger.warning("Unable to get Hue lights.")
                 return
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return
         for light in hueResponse.json():
             self.lights.append(light)
         return
 
-    def getLightsV2(self):
-        headers = {"hue-application-key": {self.username}}
-        self.lights = []
+    '''
+    Keep-alive session shared by all V2 requests
+    '''
+
+    def getSession(self) -> httpx.AsyncClient:
+        if (self.session is None):
+            self.session = httpx.AsyncClient(
+                headers={"hue-application-key": self.username},
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_keepalive_connections=LIGHT_COMMANDS_PER_SECOND))
+        return self.session
+
+    async def close(self) -> None:
+        if (self.session):
+            await self.session.aclose()
+            self.session = None
+
+    async def getResourceV2(self, resource: str) -> list[dict]:
+        hueResponse = await self.getSession().get(f"{self.urlV2}/resource/{resource}")
+        if (not hueResponse.is_success):
+            logger.warning(f"Unable to get Hue {resource}: {hueResponse.status_code}")
+            return []
+        return hueResponse.json()["data"]
+
+    '''
+    Fetches the light IDs and the grouped_light of the configured room or zone
+    (HUE_GROUP), or of the whole bridge if no group is configured. The
+    previous lights, e.g. restored from the state snapshot, stay in use until
+    the lookup succeeds.
+    '''
+
+    async def getLightsV2(self):
         if (self.username == ""):
             return
+        groupedLight = None
         try:
-            hueResponse = requests.get(
-                f"{self.urlV2}/resource/light/",
-                headers=headers,
-            )
-            if (not hueResponse.ok):
-                logging.warning("Unable to get Hue lights.")
-                return
+            if (self.groupName):
+                groups = await self.getResourceV2("room") + await self.getResourceV2("zone")
+                groups = [group for group in groups
+                          if group.get("metadata", {}).get("name") == self.groupName]
+                if (not groups):
+                    logger.warning(f"No Hue room or zone called '{self.groupName}'.")
+            else:
+                groups = await self.getResourceV2("bridge_home")
+            for group in groups[:1]:
+                for service in group.get("services", []):
+                    if (service["rtype"] == "grouped_light"):
+                        groupedLight = service["rid"]
+
+            lights = await self.getResourceV2("light")
+            if (self.groupName and groups):
+                # Lights are children of devices in rooms and of zones directly
+                children = {child["rid"] for child in groups[0].get("children", [])}
+                lights = [light for light in lights
+                          if light["id"] in children or light.get("owner", {}).get("rid") in children]
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return
-        for light in hueResponse.json():
-            self.lights.append(light)
+        signals = None
+        self.lights = [light["id"] for light in lights]
+        self.groupedLight = groupedLight
+        for light in lights:
+            supported = set(light.get("signaling", {}).get("signal_values", []))
+            signals = supported if signals is None else signals & supported
+            # Seed the cache with what the bridge reports
+            self.cacheLightState(light["id"], {
+                "on": {"on": light.get("on", {}).get("on")},
+                "dimming": {"brightness": light.get("dimming", {}).get("brightness")},
+                "color": {"xy": light.get("color", {}).get("xy")},
+            })
+        self.signals = signals or set()
         return
 
+    def toSnapshot(self) -> dict:
+        return {"lights": list(self.lights), "groupedLight": self.groupedLight,
+                "signals": sorted(self.signals)}
+
+    def restore(self, snapshot: dict) -> None:
+        self.lights = list(snapshot.get("lights", []))
+        self.groupedLight = snapshot.get("groupedLight")
+        self.signals = set(snapshot.get("signals", []))
+
+    def cacheLightState(self, light: str, body: dict) -> None:
+        entry = self.lightStates.setdefault(light, {})
+        now = time.monotonic()
+        for key, value in body.items():
+            if (key != "dynamics"):
+                entry[key] = (value, now)
+
+    '''
+    Returns the parts of body that differ from the cached state of the light
+    '''
+
+    def diffLightState(self, light: str, body: dict) -> dict:
+        entry = self.lightStates.get(light, {})
+        now = time.monotonic()
+        diff = {}
+        for key, value in body.items():
+            cached = entry.get(key)
+            if (key == "dynamics"):
+                continue
+            if (cached is None or cached[0] != value or now - cached[1] > STATE_CACHE_TTL):
+                diff[key] = value
+        # Transition settings only apply to the command they are sent with
+        if (diff and "dynamics" in body):
+            diff["dynamics"] = body["dynamics"]
+        return diff
+
+    '''
+    Forgets the cached light states, e.g. after something else changed the lights
+    '''
+
+    def invalidateCache(self) -> None:
+        self.lightStates = {}
+
     def setAllLights(self, color):
         try:
             for light in self.lights:
                 hueResponse = requests.put(
                     f"{self.url}/{self.username}/lights/{light}/state",
                     json={"on": True, "sat": 254, "bri": 200, "hue": color})
-                logging.debug(f"Hue light {light}: {hueResponse.status_code}")
+                logger.debug("Hue light %s: %s", light, hueResponse.status_code)
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return
 
-    def setAllLightsV2(self, colorX, colorY):
-        headers = {"hue-application-key": {self.username}}
+    '''
+    Applies the same state to all lights, in one grouped_light command when
+    the group is known and otherwise with concurrent per-light commands.
+    '''
+
+    async def updateAllLightsV2(self, body: dict) -> None:
+        started = time.monotonic()
         try:
-            for light in self.lights:
-                hueResponse = requests.put(
-                    f"{self.urlV2}/resource/light/{light}",
-                    headers=headers,
-                    json={
-                        "dimming": {"brightness": 200.0},
-                        "color": {"xy": {"x": colorX, "y": colorY}},
-                    },
-                )
-                logging.debug(f"Hue light V2 {light}: {hueResponse.status_code}")
+            if (self.groupedLight):
+                # Send every part of the state that at least one light is missing
+                diff = {}
+                for light in self.lights or [None]:
+                    diff.update(self.diffLightState(light, body))
+                if (not diff):
+                    self.skippedCommands += 1
+                    SKIPPED_COMMANDS.inc()
+                    return
+                await self.groupLimiter.acquire()
+                with REQUEST_LATENCY.labels(resource="grouped_light").time():
+                    hueResponse = await self.getSession().put(
+                        f"{self.urlV2}/resource/grouped_light/{self.groupedLight}", json=diff)
+                logger.debug("Hue grouped light %s: %s", self.groupedLight, hueResponse.status_code)
+                if (hueResponse.is_success):
+                    for light in self.lights or [None]:
+                        self.cacheLightState(light, diff)
+            else:
+                await asyncio.gather(*(self.updateLightV2(light, body) for light in self.lights))
+        except asyncio.CancelledError:
+            # Cut off by stopEffect() or a caller's timeout while a command may
+            # already have reached the bridge, so the cache can't be trusted
+            self.invalidateCache()
+            raise
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
+            return
+        self.lastUpdateLatency = time.monotonic() - started
+        UPDATE_LATENCY.observe(self.lastUpdateLatency)
+        logger.debug("All Hue lights changed in %.0f ms", self.lastUpdateLatency * 1000)
+
+    async def updateLightV2(self, light: str, body: dict) -> None:
+        diff = self.diffLightState(light, body)
+        if (not diff):
+            self.skippedCommands += 1
+            SKIPPED_COMMANDS.inc()
             return
+        await self.lightLimiter.acquire()
+        with REQUEST_LATENCY.labels(resource="light").time():
+            hueResponse = await self.getSession().put(
+                f"{self.urlV2}/resource/light/{light}", json=diff)
+        logger.debug("Hue light V2 %s: %s", light, hueResponse.status_code)
+        if (hueResponse.is_success):
+            self.cacheLightState(light, diff)
+
+    async def setAllLightsV2(self, colorX, colorY):
+        await self.stopEffect()
+        await self.updateAllLightsV2({
+            "on": {"on": True},
+            "dimming": {"brightness": 100.0},
+            "color": {"xy": {"x": colorX, "y": colorY}},
+        })
 
     def turnOffAllLights(self):
         try:
@@ -141,21 +328,88 @@ class Hue:
                 hueResponse = requests.put(
                     f"{self.url}/{self.username}/lights/{light}/state",
                     json={"on": False})
-                logging.debug(f"Hue light {light}: {hueResponse.status_code}")
+                logger.debug("Hue light %s: %s", light, hueResponse.status_code)
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
             return
 
-    def turnOffAllLightsV2(self):
-        headers = {"hue-application-key": {self.username}}
+    async def turnOffAllLightsV2(self):
+        await self.stopEffect()
+        await self.updateAllLightsV2({"on": {"on": False}})
+
+    '''
+    Light effects
+
+    startEffect() runs "blink" or "breathe" in the given color until another
+    effect is started, stopEffect() is called or the lights are set with
+    setAllLightsV2/turnOffAllLightsV2. A blink uses the bridge's own signaling
+    when every light supports it, so a single request per light starts it.
+    Other effects run as a background task that does not block the caller.
+    '''
+
+    def effectRunning(self) -> bool:
+        return self.effect is not None
+
+    async def startEffect(self, effect: str, colorX: float, colorY: float,
+                          period: float = 2.0) -> None:
+        await self.stopEffect()
+        color = {"xy": {"x": colorX, "y": colorY}}
+        if (effect == "blink" and self.signals & {"on_off_color", "on_off"}):
+            if ("on_off_color" in self.signals):
+                signaling = {"signal": "on_off_color", "colors": [color]}
+            else:
+                await self.updateAllLightsV2({"on": {"on": True}, "color": color})
+                signaling = {"signal": "on_off"}
+            signaling["duration"] = NATIVE_EFFECT_DURATION * 1000
+            await self.signalAllLightsV2(signaling)
+            self.nativeEffect = True
+        elif (effect in ("blink", "breathe")):
+            self.effectTask = asyncio.create_task(
+                self.runEffect(effect, color, period))
+        else:
+            logger.warning(f"Unknown Hue effect '{effect}'")
+            return
+        self.effect = effect
+        logger.debug(f"Hue effect {effect} started")
+
+    async def stopEffect(self) -> None:
+        if (self.effectTask):
+            self.effectTask.cancel()
+            try:
+                await self.effectTask
+            except asyncio.CancelledError:
+                pass
+            self.effectTask = None
+        if (self.nativeEffect):
+            self.nativeEffect = False
+            await self.signalAllLightsV2({"signal": "no_signal"})
+            # The bridge left the lights in whatever phase the signal was in
+            self.invalidateCache()
+        self.effect = None
+
+    async def runEffect(self, effect: str, color: dict, period: float) -> None:
+        phase = False
+        while (True):
+            phase = not phase
+            if (effect == "blink"):
+                body = {"on": {"on": phase}}
+                if (phase):
+                    body["color"] = color
+            else:
+                body = {"on": {"on": True}, "color": color,
+                        "dimming": {"brightness": 100.0 if phase else 20.0},
+                        "dynamics": {"duration": int(period / 2 * 1000)}}
+            await self.updateAllLightsV2(body)
+            await asyncio.sleep(period / 2)
+
+    async def signalAllLightsV2(self, signaling: dict) -> None:
+        async def signal(light):
+            await self.lightLimiter.acquire()
+            with REQUEST_LATENCY.labels(resource="signaling").time():
+                hueResponse = await self.getSession().put(
+                    f"{self.urlV2}/resource/light/{light}", json={"signaling": signaling})
+            logger.debug("Hue light V2 %s signaling: %s", light, hueResponse.status_code)
         try:
-            for light in self.lights:
-                hueResponse = requests.put(
-                    f"{self.urlV2}/resource/light/{light}",
-                    headers=headers,
-                    json={"on": {"on": False}},
-                )
-                logging.debug(f"Hue light {light}: {hueResponse.status_code}")
+            await asyncio.gather(*(signal(light) for light in self.lights))
         except Exception as e:
-            logging.error(e)
-            return
+            logger.error(e)
@@ -0,0 +1,277 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import multiprocessing
+
+from sampletrace import VALUES
+
+
+'''
+Load-testing simulator for thousands of virtual Shelly plugs
+
+Serves GET /meter/<n> for plugs 0..plugs-1, each with its own brew profile,
+on a plain asyncio protocol with keep-alive and pipelining, so one process
+answers tens of thousands of requests per second. Profiles:
+    random  every plug brews on its own randomized schedule (default)
+    trace   every plug plays the trace in sampletrace.py, or --trace, from its
+            own offset
+Responses can be delayed by --latency with gaussian --jitter, and requests
+can fail with HTTP 500 (--error-rate), hang without an answer
+(--hang-rate) or have their connection dropped (--drop-rate). Every
+--report seconds each process prints its request rate and latency
+percentiles; GET /stats returns the totals. --processes shares the port
+between processes with SO_REUSEPORT.
+
+python loadsim.py --plugs 5000 --latency 0.02 --jitter 0.01 --error-rate 0.001
+SENSOR_URL=http://localhost:8080/meter/0,http://localhost:8080/meter/1,...
+'''
+
+HANG_SECONDS = 30.0  # a hanging request's connection is closed after this long
+
+
+'''
+Plug brewing on its own randomized schedule: off, brewing, hot plate, off
+'''
+
+
+class RandomPlug:
+    def __init__(self, rng: random.Random):
+        self.offSeconds = rng.uniform(1200, 7200)
+        self.brewSeconds = rng.uniform(300, 420)
+        self.hotSeconds = rng.uniform(600, 2400)
+        self.brewLevel = rng.uniform(1200, 1600)
+        self.hotLevel = rng.uniform(80, 150)
+        self.cycle = self.offSeconds + self.brewSeconds + self.hotSeconds
+        self.offset = rng.uniform(0, self.cycle)
+
+    def power(self, now: float) -> float:
+        t = (now + self.offset) % self.cycle - self.offSeconds
+        if (t < 0):
+            return 0.0
+        level = self.brewLevel if t < self.brewSeconds else self.hotLevel
+        return round(level * random.uniform(0.97, 1.03), 1)
+
+
+'''
+Plug playing a recorded trace, one value per interval, from its own offset
+'''
+
+
+class TracePlug:
+    def __init__(self, values: list[float], interval: float, rng: random.Random):
+        self.values = values
+        self.interval = interval
+        self.offset = rng.randrange(len(values))
+
+    def power(self, now: float) -> float:
+        return self.values[(int(now / self.interval) + self.offset) % len(self.values)]
+
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.hangs = 0
+        self.drops = 0
+        self.latencies = []  # seconds, since the last report
+
+    def toDict(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors,
+                "hangs": self.hangs, "drops": self.drops}
+
+
+'''
+HTTP/1.1 protocol for one connection. Requests are answered in order; while
+a delayed response is pending, pipelined requests wait in the buffer.
+Immediate responses are written from the loop in next(), so any number of
+pipelined requests never recurses.
+'''
+
+
+class PlugProtocol(asyncio.Protocol):
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.buffer = b""
+        self.busy = False
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exception) -> None:
+        self.transport = None
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        self.next()
+
+    def next(self) -> None:
+        while (not self.busy and self.open() and b"\r\n\r\n" in self.buffer):
+            head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+            requestLine = head.split(b"\r\n", 1)[0].split(b" ")
+            target = requestLine[1].decode("latin-1") if len(requestLine) > 1 else "/"
+            self.simulator.handle(self, target, time.perf_counter())
+
+    def open(self) -> bool:
+        return self.transport is not None and not self.transport.is_closing()
+
+    def respond(self, status: int, body: bytes, started: float) -> None:
+        if (not self.open()):
+            return
+        self.transport.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n%s"
+                             % (status, REASONS[status], len(body), body))
+        self.simulator.stats.latencies.append(time.perf_counter() - started)
+        self.busy = False
+
+    '''
+    Answers a delayed request, then the requests pipelined behind it
+    '''
+
+    def respondLater(self, status: int, body: bytes, started: float) -> None:
+        self.respond(status, body, started)
+        self.next()
+
+
+REASONS = {200: b"OK", 404: b"Not Found", 500: b"Internal Server Error"}
+
+
+class Simulator:
+    def __init__(self, plugs: list, latency: float = 0.0, jitter: float = 0.0,
+                 errorRate: float = 0.0, hangRate: float = 0.0, dropRate: float = 0.0):
+        self.plugs = plugs
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.hangRate = hangRate
+        self.dropRate = dropRate
+        self.stats = Stats()
+        self.loop = None
+
+    def handle(self, connection: PlugProtocol, target: str, started: float) -> None:
+        self.stats.requests += 1
+        path = target.partition("?")[0]
+        if (path == "/stats"):
+            connection.respond(200, json.dumps(self.stats.toDict()).encode(), started)
+            return
+        index = path[len("/meter/"):] if path.startswith("/meter/") else ""
+        if (not index.isdigit() or int(index) >= len(self.plugs)):
+            connection.respond(404, b'{"error":"no such plug"}', started)
+            return
+
+        chance = random.random()
+        if (chance < self.dropRate):
+            self.stats.drops += 1
+            connection.transport.abort()
+            return
+        chance -= self.dropRate
+        if (chance < self.hangRate):
+            self.stats.hangs += 1
+            connection.busy = True
+            self.loop.call_later(HANG_SECONDS, connection.transport.close)
+            return
+        chance -= self.hangRate
+        if (chance < self.errorRate):
+            self.stats.errors += 1
+            status, body = 500, b'{"error":"injected"}'
+        else:
+            power = self.plugs[int(index)].power(time.time())
+            status, body = 200, b'{"power":%r}' % power
+
+        delay = self.latency + (random.gauss(0, self.jitter) if self.jitter else 0.0)
+        if (delay > 0):
+            connection.busy = True
+            self.loop.call_later(delay, connection.respondLater, status, body, started)
+        else:
+            connection.respond(status, body, started)
+
+    async def report(self, interval: float, worker: int) -> None:
+        last = self.stats.requests
+        lastTime = time.perf_counter()
+        while (True):
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            latencies, self.stats.latencies = sorted(self.stats.latencies), []
+            rate = (self.stats.requests - last) / (now - lastTime)
+            last, lastTime = self.stats.requests, now
+            if (latencies):
+                p50 = latencies[len(latencies) // 2] * 1000
+                p99 = latencies[int(len(latencies) * 0.99)] * 1000
+                print(f"[{worker}] {rate:8.0f} req/s  latency p50 {p50:6.1f} ms  p99 {p99:6.1f} ms  "
+                      f"errors {self.stats.errors}  hangs {self.stats.hangs}  drops {self.stats.drops}",
+                      flush=True)
+
+    async def serve(self, host: str, port: int, report: float, worker: int, reusePort: bool) -> None:
+        self.loop = asyncio.get_running_loop()
+        server = await self.loop.create_server(
+            lambda: PlugProtocol(self), host, port, reuse_port=reusePort, backlog=4096)
+        async with server:
+            await self.report(report, worker)
+
+
+def makePlugs(count: int, profile: str, trace: list[float] | None,
+              interval: float, seed: int) -> list:
+    rng = random.Random(seed)
+    values = trace or VALUES
+    if (profile == "trace"):
+        return [TracePlug(values, interval, rng) for _ in range(count)]
+    return [RandomPlug(rng) for _ in range(count)]
+
+
+def runWorker(worker: int, args) -> None:
+    random.seed(args.seed + worker)
+    trace = None
+    if (args.trace):
+        from replay import loadTrace
+        trace = [sample[1] for sample in loadTrace(args.trace)]
+    simulator = Simulator(
+        makePlugs(args.plugs, args.profile, trace, args.interval, args.seed),
+        latency=args.latency, jitter=args.jitter, errorRate=args.error_rate,
+        hangRate=args.hang_rate, dropRate=args.drop_rate)
+    try:
+        asyncio.run(simulator.serve(args.host, args.port, args.report, worker,
+                                    reusePort=args.processes > 1))
+    except KeyboardInterrupt:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Simulate thousands of Shelly plugs for load tests")
+    parser.add_argument("--plugs", type=int, default=1000)
+    parser.add_argument("--profile", choices=("random", "trace"), default="random")
+    parser.add_argument("--trace", help="CSV or JSON lines trace for the trace profile")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="seconds per trace value")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of HTTP 500 answers")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="share of requests never answered")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of dropped connections")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--processes", type=int, default=1, help="server processes sharing the port")
+    parser.add_argument("--report", type=float, default=5.0, help="seconds between reports")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"Serving {args.plugs} plugs at http://{args.host}:{args.port}/meter/<0-{args.plugs - 1}>"
+          f" in {args.processes} process(es)", flush=True)
+    if (args.processes == 1):
+        runWorker(0, args)
+        return
+    workers = [multiprocessing.Process(target=runWorker, args=(worker, args))
+               for worker in range(args.processes)]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.join()
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import queue
+import logging
+import logging.handlers
+from datetime import datetime
+
+
+'''
+Logging setup for the bot
+
+Log calls only put the record on an in-memory queue. A QueueListener thread
+formats the records and writes them to a rotating file, so sampling never
+waits on the disk. Records are JSON lines by default. Configured from the
+environment:
+    LOG_FILE       log file (default coffeebot.log)
+    LOG_LEVEL      level of everything not listed in LOG_LEVELS (default INFO)
+    LOG_LEVELS     per-module levels, e.g. "hue=WARNING,db.spool=DEBUG"
+    LOG_FORMAT     "json" (default) or "text"
+    LOG_MAX_BYTES  rotate when the file reaches this size (default 10 MB)
+    LOG_BACKUPS    rotated files to keep (default 5)
+    LOG_ROTATE_AT  rotate on time instead of size, e.g. "midnight" or "h"
+Warnings and errors are also written to stderr.
+'''
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+QUIET_LOGGERS = ("requests", "urllib3", "httpx", "httpcore", "websockets", "pymongo")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if (record.exc_info):
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+'''
+Parses "module=LEVEL,module=LEVEL" into a dict
+'''
+
+
+def parseLevels(levels: str) -> dict:
+    result = {}
+    for item in (levels or "").split(","):
+        name, _, level = item.partition("=")
+        if (name.strip() and level.strip()):
+            result[name.strip()] = level.strip().upper()
+    return result
+
+
+'''
+Routes all logging through a queue to the file and console handlers.
+Returns the started listener; stop it on exit to write out queued records.
+'''
+
+
+def setupLogging(path: str | None = None) -> logging.handlers.QueueListener:
+    path = path or os.getenv("LOG_FILE") or "coffeebot.log"
+    backups = int(os.getenv("LOG_BACKUPS") or 5)
+    if (os.getenv("LOG_ROTATE_AT")):
+        fileHandler = logging.handlers.TimedRotatingFileHandler(
+            path, when=os.getenv("LOG_ROTATE_AT"), backupCount=backups, encoding="utf-8")
+    else:
+        fileHandler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=int(os.getenv("LOG_MAX_BYTES") or 10 * 1024 * 1024),
+            backupCount=backups, encoding="utf-8")
+    if ((os.getenv("LOG_FORMAT") or "json") == "json"):
+        fileHandler.setFormatter(JsonFormatter())
+    else:
+        fileHandler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    consoleHandler = logging.StreamHandler(sys.stderr)
+    consoleHandler.setLevel(logging.WARNING)
+    consoleHandler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel((os.getenv("LOG_LEVEL") or "INFO").upper())
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+    for name, level in parseLevels(os.getenv("LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(
+        records, fileHandler, consoleHandler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,283 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Lightweight in-process metrics with a Prometheus compatible text endpoint
+
+Counters, gauges and histograms are plain Python objects updated in place, so
+recording a value costs a dict lookup and an addition (plus a bisect for
+histograms) and can stay on in production. Metrics are created once at module
+level and register themselves in REGISTRY (counter names end in _total):
+
+    SENSOR_LATENCY = metrics.Histogram(
+        "coffeebot_sensor_request_seconds", "Shelly request latency", ["brewer"])
+    SENSOR_LATENCY.labels(brewer="kitchen").observe(0.031)
+
+MetricsServer serves GET /metrics, and other modules can add routes to it,
+like the status API in history.py.
+'''
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric) -> None:
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def escapeLabel(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(labels: dict) -> str:
+    if (not labels):
+        return ""
+    return "{" + ",".join(f'{key}="{escapeLabel(value)}"' for key, value in labels.items()) + "}"
+
+
+def formatValue(value: float) -> str:
+    if (value == float("inf")):
+        return "+Inf"
+    return repr(float(value))
+
+
+'''
+Base class for a metric family, one child per label value combination
+'''
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelNames: list[str] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.children = {}
+        if (not self.labelNames):
+            self.children[()] = self.newChild()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelNames)
+        child = self.children.get(key)
+        if (child is None):
+            child = self.children[key] = self.newChild()
+        return child
+
+    def default(self):
+        return self.children[()]
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, child in list(self.children.items()):
+            lines.extend(child.samples(self.name, dict(zip(self.labelNames, key))))
+        return lines
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self, name: str, labels: dict) -> list[str]:
+        return [f"{name}{formatLabels(labels)} {formatValue(self.value)}"]
+
+
+class GaugeValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def samples(self, name: str, labels: dict) -> list[str]:
+        return [f"{name}{formatLabels(labels)} {formatValue(self.value)}"]
+
+
+class HistogramValue:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    '''
+    Context manager observing the time spent inside it
+    '''
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name: str, labels: dict) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            bucketLabels = dict(labels, le=formatValue(bound))
+            lines.append(f"{name}_bucket{formatLabels(bucketLabels)} {cumulative}")
+        lines.append(f"{name}_sum{formatLabels(labels)} {formatValue(self.sum)}")
+        lines.append(f"{name}_count{formatLabels(labels)} {self.count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: HistogramValue):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def newChild(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.default().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def newChild(self):
+        return GaugeValue()
+
+    def set(self, value: float) -> None:
+        self.default().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelNames: list[str] = (),
+                 buckets: tuple = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelNames, registry)
+
+    def newChild(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.default().observe(value)
+
+    def time(self):
+        return self.default().time()
+
+
+'''
+Minimal asyncio HTTP server for GET requests
+
+Routes map a path to a function taking the request headers (lower case names)
+and the query string, and returning (status, content type, body bytes, extra
+headers).
+'''
+
+
+class MetricsServer:
+    def __init__(self, host: str = "0.0.0.0", port: int = 9100,
+                 registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server = None
+        self.routes = {"/metrics": self.metrics}
+
+    def addRoute(self, path: str, handler) -> None:
+        self.routes[path] = handler
+
+    def metrics(self, headers: dict, query: str):
+        body = self.registry.expose().encode()
+        return 200, "text/plain; version=0.0.4; charset=utf-8", body, {}
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        if (self.server):
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (True):
+                requestLine = await reader.readline()
+                if (not requestLine):
+                    break
+                method, target, _ = requestLine.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (True):
+                    line = await reader.readline()
+                    if (line in (b"\r\n", b"\n", b"")):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                path, _, query = target.partition("?")
+                handler = self.routes.get(path)
+                if (method not in ("GET", "HEAD")):
+                    status, contentType, body, extra = 405, "text/plain", b"Method not allowed\n", {}
+                elif (handler is None):
+                    status, contentType, body, extra = 404, "text/plain", b"Not found\n", {}
+                else:
+                    status, contentType, body, extra = handler(headers, query)
+                keepAlive = headers.get("connection", "").lower() != "close"
+                response = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                            f"Content-Type: {contentType}",
+                            f"Content-Length: {len(body)}",
+                            f"Connection: {'keep-alive' if keepAlive else 'close'}"]
+                response.extend(f"{name}: {value}" for name, value in extra.items())
+                writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+                if (method != "HEAD"):
+                    writer.write(body)
+                await writer.drain()
+                if (not keepAlive):
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
@@ -0,0 +1,239 @@
+import time
+import asyncio
+import logging
+import httpx
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+SINK_TIMEOUT = 10.0  # seconds one delivery attempt may take
+RETRIES = 2  # attempts after the first that failed or timed out
+RETRY_DELAY = 1.0  # seconds, doubled after every failed attempt
+
+# CIE xy colors of the statuses on the Hue lights
+GREEN = (0.1673, 0.5968)
+YELLOW = (0.4878, 0.4613)
+RED = (0.6758, 0.3008)
+COLORS = {"brewing": YELLOW, "done": GREEN, "saving": GREEN, "off": RED}
+
+DELIVERY_LATENCY = Histogram(
+    "coffeebot_notification_seconds", "Time to deliver a status to a sink", ["sink"])
+DELIVERY_FAILURES = Counter(
+    "coffeebot_notification_failures_total", "Statuses a sink did not get within its retries", ["sink"])
+COALESCED = Counter(
+    "coffeebot_notifications_coalesced_total", "Statuses replaced by a newer one before delivery", ["sink"])
+
+
+'''
+A destination for brewer statuses. The status is a key of Slack.messages:
+"brewing", "done", "saving" or "off". send() raises if the status was not
+delivered, and is retried within the sink's timeout and retries; an
+exception with a `retryAfter` attribute makes the retry wait at least that
+many seconds, outside the timeout. stale()
+tells the dispatcher that a status it delivered has been undone, e.g. by
+someone switching the lights, and should be sent again. `key` tells the
+sinks apart in the brewer's announced statuses and is saved in the snapshot.
+'''
+
+
+class Sink:
+    name = "sink"
+
+    def __init__(self, timeout: float = SINK_TIMEOUT, retries: int = RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.key = self.name
+
+    async def send(self, brewer, status: str) -> None:
+        raise NotImplementedError
+
+    def stale(self, status: str) -> bool:
+        return False
+
+    async def close(self) -> None:
+        pass
+
+
+'''
+Shows the status in the brewer's pinned Slack status message
+'''
+
+
+class SlackSink(Sink):
+    name = "slack"
+
+    def __init__(self, slack, **kwargs):
+        super().__init__(**kwargs)
+        self.slack = slack
+        # A Retry-After that doesn't fit in the timeout is waited out by the
+        # dispatcher between attempts instead of within one
+        slack.maxRetryWait = min(slack.maxRetryWait, self.timeout / 2)
+
+    async def send(self, brewer, status: str) -> None:
+        await self.slack.setStatus(brewer.name, brewer.label(self.slack.messages[status]))
+
+
+'''
+Shows the status as the color of the Hue lights, blinking while brewing
+'''
+
+
+class HueSink(Sink):
+    name = "hue"
+
+    def __init__(self, hue, **kwargs):
+        super().__init__(**kwargs)
+        self.hue = hue
+
+    async def send(self, brewer, status: str) -> None:
+        await self.hue.setAllLightsV2(*COLORS[status])
+        if (status == "brewing"):
+            await self.hue.startEffect("blink", *COLORS[status])
+
+    def stale(self, status: str) -> bool:
+        # Restart the blink if something else has stopped it
+        return status == "brewing" and not self.hue.effectRunning()
+
+
+'''
+POSTs every status as JSON to a URL:
+{"site": ..., "brewer": ..., "status": ..., "state": ..., "ts": seconds since the epoch}
+'''
+
+
+class WebhookSink(Sink):
+    name = "webhook"
+
+    def __init__(self, url: str, session: httpx.AsyncClient | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.key = f"{self.name} {url}"
+        self.session = session
+        self.ownSession = session is None
+
+    async def send(self, brewer, status: str) -> None:
+        if (self.session is None):
+            self.session = httpx.AsyncClient(timeout=self.timeout)
+        response = await self.session.post(self.url, json={
+            "site": brewer.site, "brewer": brewer.name, "status": status,
+            "state": brewer.detector.state, "ts": time.time()})
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        if (self.session and self.ownSession):
+            await self.session.aclose()
+            self.session = None
+
+
+'''
+Dispatcher class responsible for sending brewer statuses to all sinks
+
+Every sink gets every status concurrently, with one worker per sink and
+brewer, so a slow or hung sink never delays the others. Each attempt is cut
+off after the sink's timeout and failed attempts are retried with backoff up
+to the sink's retries. A status that comes in while an older one is still
+being delivered replaces any status waiting behind it, so after rapid flips
+only the latest state goes out, and not at all if the sink already shows it;
+a newer status also ends the retries of an older one. After a delivery the
+status is recorded per sink in the brewer's announced statuses and its
+snapshot saved, so after a restart resend() reaches just the sinks that
+missed it.
+'''
+
+
+class Dispatcher:
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.pending = {}  # (sink index, brewer key): (brewer, status)
+        self.workers = {}  # (sink index, brewer key): Task
+        self.delivered = {}  # (sink index, brewer key): last status delivered
+
+    def send(self, brewer, status: str) -> None:
+        for index in range(len(self.sinks)):
+            self.queue(index, brewer, status)
+
+    '''
+    Sends the status to the sinks that have not delivered it for the brewer
+    '''
+
+    def resend(self, brewer, status: str) -> None:
+        for index, sink in enumerate(self.sinks):
+            if (brewer.announced.get(sink.key) != status):
+                self.queue(index, brewer, status)
+
+    '''
+    Sends the status again to the sinks that report it as stale and have
+    nothing in flight for the brewer
+    '''
+
+    def refresh(self, brewer, status: str) -> None:
+        for index, sink in enumerate(self.sinks):
+            worker = self.workers.get((index, brewer.key))
+            if ((worker is None or worker.done()) and sink.stale(status)):
+                self.queue(index, brewer, status)
+
+    def queue(self, index: int, brewer, status: str) -> None:
+        key = (index, brewer.key)
+        if (key in self.pending):
+            COALESCED.labels(sink=self.sinks[index].name).inc()
+        self.pending[key] = (brewer, status)
+        worker = self.workers.get(key)
+        if (worker is None or worker.done()):
+            self.workers[key] = asyncio.create_task(self.work(key))
+
+    async def work(self, key: tuple) -> None:
+        sink = self.sinks[key[0]]
+        while (key in self.pending):
+            brewer, status = self.pending.pop(key)
+            if (status == self.delivered.get(key) and not sink.stale(status)):
+                continue
+            self.delivered.pop(key, None)
+            brewer.announced.pop(sink.key, None)
+            if (await self.deliver(sink, key, brewer, status)):
+                self.delivered[key] = status
+                brewer.announced[sink.key] = status
+            # Saves the announced status and new Slack message timestamps
+            brewer.changed()
+
+    async def deliver(self, sink: Sink, key: tuple, brewer, status: str) -> bool:
+        latency = DELIVERY_LATENCY.labels(sink=sink.name)
+        for attempt in range(sink.retries + 1):
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(sink.send(brewer, status), timeout=sink.timeout)
+                latency.observe(time.monotonic() - started)
+                return True
+            except asyncio.TimeoutError:
+                error = f"timed out after {sink.timeout:g} s"
+            except Exception as e:
+                error = e
+            if (key in self.pending):
+                logger.warning(f"{brewer.label(f'{sink.name} {status}')} failed, "
+                               f"superseded by a newer status: {error}")
+                return False
+            if (attempt < sink.retries):
+                # Rate limited, wait as long as asked
+                delay = max(RETRY_DELAY * 2 ** attempt, getattr(error, "retryAfter", None) or 0.0)
+                logger.warning(f"{brewer.label(f'{sink.name} {status}')} failed, "
+                               f"retrying in {delay:g} s: {error}")
+                await asyncio.sleep(delay)
+        DELIVERY_FAILURES.labels(sink=sink.name).inc()
+        logger.error(f"{brewer.label(f'{sink.name} {status}')} failed: {error}")
+        return False
+
+    '''
+    Waits until everything queued has been delivered or given up on
+    '''
+
+    async def drain(self) -> None:
+        while (any(not worker.done() for worker in self.workers.values())):
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    async def close(self) -> None:
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.workers.clear()
+        for sink in self.sinks:
+            await sink.close()
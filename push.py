@@ -0,0 +1,125 @@
+import json
+import asyncio
+import logging
+import websockets
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+RECONNECT_DELAY = 1.0  # seconds, doubled after every failed attempt
+MAX_RECONNECT_DELAY = 60.0
+
+
+'''
+Returns the Shelly generation of the plug behind a sensor URL: 1 for the
+Gen1 HTTP API, e.g. "http://192.168.0.10/meter/0", and 2 for the RPC API of
+Gen2 and later plugs, a "/rpc/..." URL or the bare address, e.g.
+"http://192.168.0.20". Only Gen2 plugs can push readings.
+'''
+
+
+def shellyGeneration(sensorUrl: str) -> int:
+    path = urlsplit(sensorUrl).path.rstrip("/")
+    return 2 if (path == "" or path == "/rpc" or path.startswith("/rpc/")) else 1
+
+
+'''
+Returns the URL to poll for power: the sensor URL of a Gen1 plug or of a
+Gen2 RPC method, else the Switch.GetStatus method of the Gen2 plug, e.g.
+"http://192.168.0.20" -> "http://192.168.0.20/rpc/Switch.GetStatus?id=0"
+'''
+
+
+def pollUrlFor(sensorUrl: str) -> str:
+    parts = urlsplit(sensorUrl)
+    if (shellyGeneration(sensorUrl) == 1 or parts.path.startswith("/rpc/")):
+        return sensorUrl
+    return f"{parts.scheme}://{parts.netloc}/rpc/Switch.GetStatus?id=0"
+
+
+'''
+Returns the WebSocket RPC URL of a Gen2 Shelly plug, e.g.
+"http://192.168.0.20" -> "ws://192.168.0.20/rpc"
+'''
+
+
+def pushUrlFor(sensorUrl: str) -> str:
+    parts = urlsplit(sensorUrl)
+    scheme = "wss" if parts.scheme == "https" else "ws"
+    return f"{scheme}://{parts.netloc}/rpc"
+
+
+'''
+Extracts the power [Watt] from a polled status: "power" of a Gen1 meter,
+"apower" of a Gen2 Switch.GetStatus, or the switch in a Shelly.GetStatus
+'''
+
+
+def powerFromStatus(generation: int, status: dict) -> float:
+    if (generation == 1):
+        return float(status["power"])
+    if ("apower" in status):
+        return float(status["apower"])
+    power = powerFromFrame({"result": status})
+    if (power is None):
+        raise KeyError("apower")
+    return power
+
+
+'''
+Extracts the power [Watt] from a Shelly RPC status or NotifyStatus frame.
+Returns None if the frame carries no power reading.
+'''
+
+
+def powerFromFrame(frame: dict) -> float | None:
+    status = frame.get("params") or frame.get("result") or {}
+    for key in ("switch:0", "pm1:0"):
+        component = status.get(key)
+        if (isinstance(component, dict) and "apower" in component):
+            return float(component["apower"])
+    return None
+
+
+'''
+PushListener class responsible for receiving pushed power readings
+
+Connects to the WebSocket RPC channel of a Shelly Gen2 device. The device
+sends NotifyStatus frames to every client that has made a request with a
+"src", so the listener asks for the status once and then receives every power
+change. `onPower` is a coroutine function awaited with each reading. The
+listener reconnects with backoff, and `connected` tells the caller whether to
+rely on pushed readings or fall back to polling.
+'''
+
+
+class PushListener:
+    def __init__(self, url: str, onPower, name: str = ""):
+        self.url = url
+        self.onPower = onPower
+        self.name = name
+        self.connected = False
+
+    async def run(self) -> None:
+        delay = RECONNECT_DELAY
+        while (True):
+            try:
+                async with websockets.connect(self.url, open_timeout=5) as connection:
+                    await connection.send(json.dumps(
+                        {"id": 1, "src": "coffeebot", "method": "Shelly.GetStatus"}))
+                    self.connected = True
+                    delay = RECONNECT_DELAY
+                    logger.info(f"{self.name} receiving pushed power readings from {self.url}")
+                    async for message in connection:
+                        power = powerFromFrame(json.loads(message))
+                        if (power is not None):
+                            await self.onPower(power)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"{self.name} push channel {self.url} lost: {e}")
+            finally:
+                self.connected = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
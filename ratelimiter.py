@@ -0,0 +1,28 @@
+import time
+import asyncio
+
+
+'''
+Token bucket limiting how many requests are sent per second, e.g. to stay
+within the Hue bridge's command budget or a Slack API rate tier.
+'''
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while (True):
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if (self.tokens >= 1.0):
+                    self.tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
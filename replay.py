@@ -0,0 +1,315 @@
+import os
+import sys
+import csv
+import json
+import time
+import heapq
+import random
+import asyncio
+import logging
+import argparse
+import importlib.util
+from datetime import datetime
+
+from slack import Slack
+from notify import Dispatcher, SlackSink, HueSink
+
+
+'''
+Accelerated replay of power traces through the bot's detection and
+notification logic, on a virtual clock.
+
+The brewer, detector and handlers are the ones in coffee-bot.py. Slack and Hue
+are replaced by fakes that record what would have been sent, and timers such
+as the drip delay run on the virtual clock, so hours of samples replay in
+milliseconds. Traces come from a CSV file (ts, power and optionally the true
+state in a "label" column), a mongoexport JSON lines file, the trace in
+simulator.py, or a synthetic brew profile with known transitions.
+
+python replay.py --synthetic 50
+python replay.py --trace samples.csv --json
+'''
+
+
+def loadCoffeeBot():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "coffee-bot.py")
+    spec = importlib.util.spec_from_file_location("coffeebot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+'''
+Timer heap driven by the replay instead of the wall clock
+'''
+
+
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+        self.sequence = 0
+
+    def call_later(self, delay: float, callback):
+        handle = VirtualTimer(self.now + delay, callback)
+        heapq.heappush(self.timers, (handle.when, self.sequence, handle))
+        self.sequence += 1
+        return handle
+
+    '''
+    Moves the clock forward, firing the timers that fall due on the way
+    '''
+
+    def advance(self, until: float) -> None:
+        while (self.timers and self.timers[0][0] <= until):
+            when, _, handle = heapq.heappop(self.timers)
+            self.now = when
+            if (not handle.cancelled):
+                handle.callback()
+        self.now = max(self.now, until)
+
+
+class VirtualTimer:
+    def __init__(self, when: float, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+'''
+Fake Slack and Hue clients recording (virtual time, call, arguments)
+'''
+
+
+class FakeSlack:
+    def __init__(self, clock: VirtualClock, record: list):
+        self.clock = clock
+        self.record = record
+        self.messages = Slack().messages
+        self.maxRetryWait = float("inf")
+
+    async def setStatus(self, key: str, text: str) -> None:
+        self.record.append((self.clock.now, "slack", text))
+
+
+class FakeHue:
+    def __init__(self, clock: VirtualClock, record: list):
+        self.clock = clock
+        self.record = record
+        self.effect = None
+
+    async def setAllLightsV2(self, colorX, colorY):
+        self.effect = None
+        self.record.append((self.clock.now, "hue", (colorX, colorY)))
+
+    async def turnOffAllLightsV2(self):
+        self.effect = None
+        self.record.append((self.clock.now, "hue", "off"))
+
+    async def startEffect(self, effect, colorX, colorY, period=2.0):
+        self.effect = effect
+        self.record.append((self.clock.now, "hue", effect))
+
+    async def stopEffect(self):
+        self.effect = None
+
+    def effectRunning(self) -> bool:
+        return self.effect is not None
+
+
+'''
+Trace loaders, all returning a list of (seconds, power, label or None)
+'''
+
+
+def parseTimestamp(value) -> float:
+    if (isinstance(value, dict)):
+        value = value.get("$date")
+    if (isinstance(value, (int, float))):
+        return float(value) / (1000 if value > 1e11 else 1)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+
+
+def loadTrace(path: str) -> list[tuple]:
+    samples = []
+    if (path.endswith(".csv")):
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                samples.append((parseTimestamp(row["ts"]), float(row["power"]),
+                                row.get("label") or None))
+    else:
+        with open(path) as f:
+            for line in f:
+                if (line.strip()):
+                    document = json.loads(line)
+                    samples.append((parseTimestamp(document["ts"]),
+                                    float(document["power"]), document.get("label")))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
+
+def simulatorTrace(interval: float) -> list[tuple]:
+    from sampletrace import VALUES
+    return [(i * interval, value, None) for i, value in enumerate(VALUES)]
+
+
+'''
+Synthetic brews: off, a brew at about 1400 W, a few minutes of fresh coffee on
+the hot plate, off again, and now and then someone re-heating old coffee.
+Labels mark the sample where the true state changes.
+'''
+
+
+def syntheticTrace(brews: int, interval: float, seed: int = 1) -> list[tuple]:
+    rng = random.Random(seed)
+    samples = []
+    t = 0.0
+
+    def phase(seconds, level, noise, label):
+        nonlocal t
+        for i in range(int(seconds / interval)):
+            power = 0.0 if level == 0.0 else max(level + rng.gauss(0, noise), 0.0)
+            samples.append((t, power, label if i == 0 else None))
+            t += interval
+
+    phase(600, 0.0, 0, None)
+    for _ in range(brews):
+        phase(rng.uniform(300, 420), 1400.0, 40.0, "brewing")
+        phase(rng.uniform(600, 2400), 120.0, 15.0, "done")
+        phase(rng.uniform(1200, 7200), 0.0, 0, "off")
+        if (rng.random() < 0.3):
+            phase(rng.uniform(300, 900), 120.0, 15.0, "heating")
+            phase(rng.uniform(600, 1800), 0.0, 0, "off")
+    return samples
+
+
+'''
+Replays the samples and returns the benchmark report
+'''
+
+
+async def replay(samples: list[tuple], interval: float) -> dict:
+    coffeebot = loadCoffeeBot()
+    clock = VirtualClock()
+    record = []
+    slack = FakeSlack(clock, record)
+    hue = FakeHue(clock, record)
+    brewer = coffeebot.Brewer("", "replay", clock=clock)
+    brewer.detector.interval = interval
+    brewer.dispatcher = Dispatcher([SlackSink(slack), HueSink(hue)])
+
+    detections = []
+    start = samples[0][0] if samples else 0.0
+    started = time.perf_counter()
+    for ts, power, _ in samples:
+        clock.advance(ts - start)
+        previous = brewer.detector.state
+        coffeebot.detect(brewer, power)
+        if (brewer.detector.state != previous):
+            detections.append((clock.now, brewer.detector.state))
+        await brewer.dispatcher.drain()
+    clock.advance(float("inf"))
+    await brewer.dispatcher.drain()
+    seconds = time.perf_counter() - started
+
+    truth = [(ts - start, label) for ts, _, label in samples if label]
+    return report(samples, truth, detections, record, seconds)
+
+
+def report(samples, truth, detections, record, seconds) -> dict:
+    duration = samples[-1][0] - samples[0][0] if samples else 0.0
+    result = {
+        "samples": len(samples),
+        "wallSeconds": round(seconds, 4),
+        "samplesPerSecond": round(len(samples) / seconds) if seconds else None,
+        "speedup": round(duration / seconds) if seconds else None,
+        "detections": len(detections),
+        "notifications": {
+            "slack": sum(1 for entry in record if entry[1] == "slack"),
+            "hue": sum(1 for entry in record if entry[1] == "hue"),
+        },
+    }
+    if (not truth):
+        return result
+
+    # Match every true transition with the first detection of the same state
+    # before the next true transition, anything left over is a false transition
+    latencies = {}
+    matched = set()
+    missed = 0
+    for i, (ts, label) in enumerate(truth):
+        nextTs = truth[i + 1][0] if i + 1 < len(truth) else float("inf")
+        for j, (detectedTs, state) in enumerate(detections):
+            if (j not in matched and state == label and ts <= detectedTs < nextTs):
+                matched.add(j)
+                latencies.setdefault(label, []).append(detectedTs - ts)
+                break
+        else:
+            missed += 1
+    # idle is a quiet state of its own, not a transition worth reporting
+    falseTransitions = sum(1 for j, (_, state) in enumerate(detections)
+                           if j not in matched and state != "idle")
+    result["transitions"] = len(truth)
+    result["missed"] = missed
+    result["falseTransitions"] = falseTransitions
+    result["latency"] = {
+        label: {"count": len(values),
+                "mean": round(sum(values) / len(values), 2),
+                "max": round(max(values), 2)}
+        for label, values in latencies.items()}
+    return result
+
+
+def printReport(result: dict) -> None:
+    print(f"Samples:            {result['samples']}")
+    print(f"Wall time:          {result['wallSeconds']} s")
+    print(f"Samples per second: {result['samplesPerSecond']}")
+    print(f"Speedup:            {result['speedup']}x real time")
+    print(f"Detections:         {result['detections']}")
+    print(f"Notifications:      {result['notifications']}")
+    if ("transitions" in result):
+        print(f"True transitions:   {result['transitions']}")
+        print(f"Missed:             {result['missed']}")
+        print(f"False transitions:  {result['falseTransitions']}")
+        for label, latency in result["latency"].items():
+            print(f"  {label:<8} latency mean {latency['mean']} s, "
+                  f"max {latency['max']} s over {latency['count']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay power traces through the coffee bot")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--trace", help="CSV or mongoexport JSON lines file with ts and power")
+    source.add_argument("--synthetic", type=int, metavar="BREWS",
+                        help="generate a synthetic trace with this many brews")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="seconds between samples for generated traces")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if (args.trace):
+        samples = loadTrace(args.trace)
+    elif (args.synthetic):
+        samples = syntheticTrace(args.synthetic, args.interval, args.seed)
+    else:
+        samples = simulatorTrace(args.interval)
+    if (not samples):
+        sys.exit("No samples to replay.")
+
+    result = asyncio.run(replay(samples, args.interval))
+    if (args.json):
+        print(json.dumps(result, indent=2))
+    else:
+        printReport(result)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,17 @@
+'''
+Power trace [Watt] of one brew on a Moccamaster KBG744 AO-B, one value every
+5 seconds: off, brewing, the hot plates keeping the coffee warm, and off
+again. Played by simulator.py, loadsim.py and replay.py; kept free of web
+dependencies so the tools that only need the values can import it.
+'''
+
+VALUES = [0.0, 0.0, 0.0, 0.0,
+          1257.4, 1523.3, 1493.6, 1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
+          1257.4, 1523.3, 1493.6, 1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
+          1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
+          102.3, 102.3, 150.4, 149.2, 100.2, 100.2, 102.3, 102.3, 150.4,
+          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
+          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
+          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
+          102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
+          0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
@@ -0,0 +1,123 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Scheduler class responsible for running a sampling callback on a fixed cadence
+
+Ticks are placed on the monotonic clock at start + n * interval, so the time a
+tick takes does not push the following ticks back. If a tick overruns one or
+more intervals, the missed ticks are skipped rather than run back to back.
+The interval can be changed with setInterval() while running.
+'''
+
+
+class Scheduler:
+    def __init__(self, interval: float, name: str = ""):
+        self.interval = interval
+        self.name = name
+        self.ticks = 0
+        self.missedTicks = 0
+        self.lastDrift = 0.0  # seconds the last tick started after its scheduled time
+        self.maxDrift = 0.0
+        self.running = False
+        self.lastTick = None  # monotonic time the last tick was scheduled for
+        self.nextTick = None
+        self.rescheduled = asyncio.Event()
+
+    '''
+    Calls the given coroutine function once per interval with the drift in seconds
+    '''
+
+    async def run(self, tick) -> None:
+        self.running = True
+        self.nextTick = time.monotonic()
+        try:
+            while (self.running):
+                delay = self.nextTick - time.monotonic()
+                if (delay > 0):
+                    self.rescheduled.clear()
+                    try:
+                        await asyncio.wait_for(self.rescheduled.wait(), timeout=delay)
+                        # Woken up by a shorter interval, sleep until the new tick
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                nextTick = self.nextTick
+                self.lastTick = nextTick
+                drift = time.monotonic() - nextTick
+                self.lastDrift = drift
+                self.maxDrift = max(self.maxDrift, drift)
+                self.ticks += 1
+                if (drift > self.interval / 2):
+                    logger.warning(
+                        f"{self.name} sample started {drift:.3f} s late")
+                try:
+                    await tick(drift)
+                except Exception as e:
+                    logger.error(f"{self.name} sample failed: {e}")
+
+                nextTick += self.interval
+                behind = time.monotonic() - nextTick
+                if (behind >= 0):
+                    missed = int(behind // self.interval) + 1
+                    self.missedTicks += missed
+                    nextTick += missed * self.interval
+                    logger.warning(
+                        f"{self.name} sample overran, skipped {missed} tick(s)")
+                self.nextTick = nextTick
+        finally:
+            self.running = False
+
+    '''
+    Changes the interval. The next tick follows the last one by the new
+    interval, so a shorter interval takes effect right away.
+    '''
+
+    def setInterval(self, interval: float) -> None:
+        if (interval == self.interval):
+            return
+        self.interval = interval
+        if (self.lastTick is not None and self.nextTick is not None):
+            self.nextTick = max(min(self.nextTick, self.lastTick + interval), time.monotonic())
+            self.rescheduled.set()
+
+    def stop(self) -> None:
+        self.running = False
+
+
+'''
+Adaptive sampling interval of one brewer
+
+next() is called with every reading and returns the interval until the next
+sample: `fast` when the reading's power level, e.g. the detector band, differs
+from the previous one or the caller reports a busy state (brewing or a state
+change waiting to be confirmed), and for `hold` seconds after that; `slow`
+while the brewer is off; `interval` otherwise. Noise within a level, such as
+the hot plates switching on and off, keeps the normal interval.
+'''
+
+
+class AdaptiveInterval:
+    def __init__(self, interval: float, slow: float, fast: float,
+                 hold: float = 30.0):
+        self.interval = interval
+        self.slow = slow
+        self.fast = fast
+        self.hold = hold
+        self.lastLevel = None
+        self.fastUntil = 0.0  # monotonic time
+
+    def next(self, level, busy: bool, quiet: bool,
+             now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        changed = self.lastLevel is not None and level != self.lastLevel
+        self.lastLevel = level
+        if (changed or busy):
+            self.fastUntil = now + self.hold
+        if (now < self.fastUntil):
+            return self.fast
+        return self.slow if quiet else self.interval
@@ -1,17 +1,14 @@
+import json
+import time
 from flask import Flask
+from flask_sock import Sock
+
+from sampletrace import VALUES
 
 app = Flask(__name__)
+sock = Sock(app)
 
-VALUES = [0.0, 0.0, 0.0, 0.0,
-          1257.4, 1523.3, 1493.6, 1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
-          1257.4, 1523.3, 1493.6, 1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
-          1300.2, 1300.7, 1302.4, 1297.2, 1300.2, 1300.7, 1302.4, 1297.2,
-          102.3, 102.3, 150.4, 149.2, 100.2, 100.2, 102.3, 102.3, 150.4,
-          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
-          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
-          149.2, 100.2, 100.2, 102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
-          102.3, 102.3, 150.4, 149.2, 100.2, 100.2,
-          0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+PUSH_INTERVAL = 5  # seconds between pushed readings
 
 VALUE_SELECTOR = 0
 
@@ -21,17 +18,42 @@ def incrementSelector():
     VALUE_SELECTOR = (VALUE_SELECTOR + 1) % len(VALUES)
 
 
+def nextValue():
+    global VALUE_SELECTOR, VALUES
+    simulatedValue = VALUES[VALUE_SELECTOR]
+    incrementSelector()
+    return simulatedValue
+
+
 @app.route('/', methods=['GET'])
 def root():
     return {"message": "Hello world!"}
 
 
+# Shelly Gen1 meter, SENSOR_URL=http://localhost:5000/meter/0
 @app.route('/meter/0', methods=['GET'])
 def getMeterValue():
-    global VALUE_SELECTOR, VALUES
-    simulatedValue = VALUES[VALUE_SELECTOR]
-    incrementSelector()
-    return {"power": simulatedValue}
+    return {"power": nextValue()}
+
+
+# Shelly Gen2 RPC over HTTP, polled when SENSOR_URL=http://localhost:5000
+@app.route('/rpc/Switch.GetStatus', methods=['GET'])
+def getSwitchStatus():
+    return {"id": 0, "apower": nextValue()}
+
+
+# Shelly Gen2 style WebSocket RPC: answers the first request with the status and
+# then pushes a NotifyStatus frame every PUSH_INTERVAL seconds
+@sock.route('/rpc')
+def rpc(ws):
+    request = json.loads(ws.receive())
+    ws.send(json.dumps({"id": request.get("id"), "src": "simulator", "dst": request.get("src"),
+                        "result": {"switch:0": {"id": 0, "apower": VALUES[VALUE_SELECTOR]}}}))
+    while (True):
+        time.sleep(PUSH_INTERVAL)
+        ws.send(json.dumps({"src": "simulator", "dst": request.get("src"), "method": "NotifyStatus",
+                            "params": {"ts": time.time(), "switch:0": {"id": 0, "apower": nextValue()}}}))
 
 
-app.run(host='localhost', port=5000)
+if (__name__ == "__main__"):
+    app.run(host='localhost', port=5000)
@@ -1,130 +1,327 @@
 import os
+import sys
 import time
+import asyncio
 import logging
-import requests
+import httpx
+from dotenv import load_dotenv
+from ratelimiter import RateLimiter
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 10.0  # seconds
+MAX_RETRIES = 3
+HISTORY_PAGE_SIZE = 200
+# chat.delete and conversations.history are Tier 3 methods, about 50 calls per minute
+TIER_3_CALLS_PER_SECOND = 50 / 60
+DELETE_WORKERS = 4
+PROGRESS_INTERVAL = 100  # deleted messages between progress reports
+
+REQUEST_LATENCY = Histogram(
+    "coffeebot_slack_request_seconds", "Slack Web API request latency", ["method"])
+RATE_LIMITED = Counter(
+    "coffeebot_slack_rate_limited_total", "Slack requests answered with 429", ["method"])
+
+
+class SlackError(Exception):
+    def __init__(self, method: str, error: str, retryAfter: float | None = None):
+        super().__init__(f"{method}: {error}")
+        self.error = error
+        self.retryAfter = retryAfter  # seconds Slack asked to wait when rate limited
+
+
+'''
+Creates a Slack API connection pool that several Slack objects can share
+'''
+
+
+def newSession() -> httpx.AsyncClient:
+    return httpx.AsyncClient(base_url="https://slack.com/api/", timeout=REQUEST_TIMEOUT)
+
+
+'''
+Slack class responsible for the messages in one channel. Token and channel
+default to SLACK_TOKEN and CHANNEL_ID. Bots for several channels can share one
+connection pool by passing the same session, see newSession().
+'''
 
 
 class Slack:
-    def __init__(self):
-        logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
-                            level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M:%S")
+    def __init__(self, authToken: str | None = None, channelId: str | None = None,
+                 session: httpx.AsyncClient | None = None):
         try:
             self.baseUrl = "https://slack.com/api/"
-            self.authToken = os.getenv('SLACK_TOKEN')
-            self.channelId = os.getenv('CHANNEL_ID')
+            self.authToken = authToken or os.getenv('SLACK_TOKEN')
+            self.channelId = channelId or os.getenv('CHANNEL_ID')
         except KeyError:
-            logging.error(
+            logger.error(
                 "Could not parse one or several of SLACK_TOKEN; CHANNEL_ID in the file .env")
             quit()
         self.messages = {"brewing": "Nu bryggs det kaffe! :building_construction:",
                          "done": "Det finns kaffe! :coffee: :brown_heart:",
                          "off": "Bryggare avstängd. :broken_heart:",
                          "saving": "Någon räddar svalnande kaffe! :ambulance:"}
+        self.lastMessageTimestamp = None
+        self.session = session
+        self.ownSession = session is None
+        # Timestamp of the pinned status message per status key (brewer)
+        self.statusTimestamps = {}
+        self.posting = {}  # key: Task posting and pinning its status message
+        self.historyLimiter = RateLimiter(TIER_3_CALLS_PER_SECOND)
+        self.deleteLimiter = RateLimiter(TIER_3_CALLS_PER_SECOND)
+        self.botId = None
+        # Longest Retry-After waited out within call(), longer ones raise
+        self.maxRetryWait = float("inf")
+
+    def toSnapshot(self) -> dict:
+        return {"statusTimestamps": dict(self.statusTimestamps),
+                "lastMessageTimestamp": self.lastMessageTimestamp}
+
+    def restore(self, snapshot: dict) -> None:
+        self.statusTimestamps.update(snapshot.get("statusTimestamps", {}))
+        self.lastMessageTimestamp = snapshot.get("lastMessageTimestamp")
+
+    '''
+    Persistent session shared by all async API calls
+    '''
+
+    def getSession(self) -> httpx.AsyncClient:
+        if (self.session is None):
+            self.session = newSession()
+        return self.session
+
+    async def close(self) -> None:
+        if (self.session and self.ownSession):
+            await self.session.aclose()
+            self.session = None
+
+    '''
+    Calls a Slack Web API method, waiting out Retry-After on rate limiting.
+    Returns the response JSON, raises SlackError if Slack reports an error,
+    with retryAfter set if rate limited for longer than maxRetryWait.
+    '''
+
+    async def call(self, method: str, payload: dict) -> dict:
+        for attempt in range(MAX_RETRIES + 1):
+            with REQUEST_LATENCY.labels(method=method).time():
+                response = await self.getSession().post(
+                    method, data=payload, headers={"Authorization": f"Bearer {self.authToken}"})
+            if (response.status_code == 429):
+                RATE_LIMITED.labels(method=method).inc()
+                retryAfter = float(response.headers.get("Retry-After", 1))
+                if (attempt == MAX_RETRIES or retryAfter > self.maxRetryWait):
+                    raise SlackError(method, "ratelimited", retryAfter)
+                logger.warning(f"Slack rate limited {method}, retrying in {retryAfter} s")
+                await asyncio.sleep(retryAfter)
+                continue
+            if (not response.is_success):
+                raise SlackError(method, f"HTTP {response.status_code}")
+            responseJson = response.json()
+            if (not responseJson.get("ok")):
+                raise SlackError(method, responseJson.get("error", "unknown_error"))
+            return responseJson
+        raise SlackError(method, "ratelimited")
+
+    '''
+    Shows the given text in the status message for key right away, posting
+    and pinning a new message if there is none to edit. Raises on failure.
+    The post is shielded from cancellation: once Slack has the message, its
+    timestamp is recorded and the message pinned even if the caller timed out,
+    and the next call waits for that instead of posting another message.
+    '''
+
+    async def setStatus(self, key: str, text: str) -> None:
+        posting = self.posting.get(key)
+        if (posting):
+            await asyncio.wait([posting])
+        timestamp = self.statusTimestamps.get(key)
+        if (timestamp):
+            try:
+                await self.call("chat.update", {
+                    "channel": self.channelId, "ts": timestamp, "text": text})
+                logger.debug("Status message %s updated.", timestamp)
+                return
+            except SlackError as e:
+                if (e.error not in ("message_not_found", "cant_update_message")):
+                    raise
+        posting = asyncio.ensure_future(self.postStatus(key, text))
+        self.posting[key] = posting
+        await asyncio.shield(posting)
+
+    async def postStatus(self, key: str, text: str) -> None:
         try:
-            self.getLastMessageTimestamp()
-        except IndexError:
-            logging.error("Could not retrieve the last Slack message.")
-            # quit()
+            timestamp = await self.postMessage(text)
+            self.statusTimestamps[key] = timestamp
+            try:
+                await self.call("pins.add", {"channel": self.channelId, "timestamp": timestamp})
+            except SlackError as e:
+                logger.warning(f"Unable to pin status message: {e}")
+        finally:
+            if (self.posting.get(key) is asyncio.current_task()):
+                del self.posting[key]
+
+    '''
+    Yields the messages in the channel history, newest first, following the
+    pagination cursor. With ownOnly set only the bot's own messages are yielded.
+    '''
+
+    async def iterateMessages(self, ownOnly: bool = False, limit: int = HISTORY_PAGE_SIZE):
+        if (ownOnly and self.botId is None):
+            self.botId = (await self.call("auth.test", {})).get("bot_id")
+        cursor = None
+        while (True):
+            payload = {"channel": self.channelId, "limit": limit}
+            if (cursor):
+                payload["cursor"] = cursor
+            await self.historyLimiter.acquire()
+            responseJson = await self.call("conversations.history", payload)
+            for message in responseJson["messages"]:
+                if (not ownOnly or message.get("bot_id") == self.botId):
+                    yield message
+            cursor = responseJson.get("response_metadata", {}).get("next_cursor")
+            if (not cursor):
+                return
 
     '''
-    Returns: list with all messages in channel history, up to the first 100
+    Returns: list with all messages in channel history
     '''
 
-    def getAllMessages(self) -> list[str]:
-        url = f"{self.baseUrl}/conversations.history"
-        headers = {"Authorization": f"Bearer {self.authToken}"}
-        params = {"channel": f"{self.channelId}"}
+    async def getAllMessages(self, ownOnly: bool = False) -> list[dict]:
         messages = []
         try:
-            response = requests.get(url, params=params, headers=headers)
-            if (not response.ok):
-                logging.warning(
-                    f"Unable to get all Slack messages: {response.status_code}")
-                return []
-            responseJson = response.json()
-            messages = responseJson["messages"]
+            async for message in self.iterateMessages(ownOnly):
+                messages.append(message)
         except Exception as e:
-            logging.error(e)
-            return messages
-
+            logger.error(f"Unable to get all Slack messages: {e}")
         return messages
 
     '''
     Gets the timestamp of last message posted to channel
     '''
 
-    def getLastMessageTimestamp(self) -> None:
-        # TODO: This seems to set the ts to None all the time on startup
-        allMessages = self.getAllMessages()
-        self.lastMessageTimestamp = allMessages[0]['ts']
+    async def getLastMessageTimestamp(self) -> None:
+        async for message in self.iterateMessages(limit=1):
+            self.lastMessageTimestamp = message["ts"]
+            return
 
     '''
-    Deletes all messages in the given list
+    Deletes the given messages, or all of the bot's own messages in the channel
+    if none are given. A bounded pool of workers deletes concurrently within
+    the chat.delete rate tier and retries failures, while the history is still
+    being paged in. Returns counts of deleted and failed messages.
     '''
 
-    def deleteMessages(self, messages) -> None:
-        url = f"{self.baseUrl}/chat.delete"
-        headers = {"Authorization": f"Bearer {self.authToken}"}
-        print(f"Deleting {len(messages)} messages...")
-        counter = 1
-        for message in messages:
-            print(f"Deleting message {counter} out of {len(messages)}")
-            params = {"channel": f"{self.channelId}", "ts": f"{message['ts']}"}
+    async def deleteMessages(self, messages=None, workers: int = DELETE_WORKERS) -> dict:
+        queue = asyncio.Queue(maxsize=workers * 2)
+        stats = {"deleted": 0, "failed": 0}
+        started = time.monotonic()
+
+        async def produce():
+            if (messages is None):
+                async for message in self.iterateMessages(ownOnly=True):
+                    await queue.put(message)
+            else:
+                for message in messages:
+                    await queue.put(message)
+
+        async def work():
+            while (True):
+                message = await queue.get()
+                try:
+                    await self.deleteWithRetry(message["ts"])
+                    stats["deleted"] += 1
+                    if (stats["deleted"] % PROGRESS_INTERVAL == 0):
+                        elapsed = time.monotonic() - started
+                        logger.info(
+                            f"Deleted {stats['deleted']} messages, {stats['failed']} failed, "
+                            f"{stats['deleted'] / elapsed:.2f} messages/s")
+                except Exception as e:
+                    logger.warning(f"Unable to delete message {message['ts']}: {e}")
+                    stats["failed"] += 1
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(work()) for _ in range(workers)]
+        try:
+            await produce()
+            await queue.join()
+        except Exception as e:
+            logger.error(f"Unable to list Slack messages: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+        stats["seconds"] = time.monotonic() - started
+        logger.info(
+            f"Messages deleted: {stats['deleted']}, failed: {stats['failed']}, "
+            f"in {stats['seconds']:.0f} s")
+        return stats
+
+    async def deleteWithRetry(self, timestamp) -> None:
+        for attempt in range(MAX_RETRIES + 1):
+            await self.deleteLimiter.acquire()
             try:
-                response = requests.post(
-                    url=url, headers=headers, params=params)
-                if (not response.ok):
-                    logging.warning(
-                        f"Unable to delete message: {response.status_code} {response.json()['error']}")
-                    return
-            except Exception as e:
-                logging.error(e)
+                await self.call("chat.delete", {"channel": self.channelId, "ts": timestamp})
                 return
-            counter += 1
-            time.sleep(1)  # await slack api rate limit
-        logging.info("Messages deleted.")
+            except SlackError as e:
+                if (e.error == "message_not_found"):
+                    return
+                if (attempt == MAX_RETRIES or e.error in ("cant_delete_message", "channel_not_found")):
+                    raise
+            except httpx.HTTPError:
+                if (attempt == MAX_RETRIES):
+                    raise
+            await asyncio.sleep(2 ** attempt)
 
     '''
     Deletes the last message
     '''
 
-    def deleteLastMessage(self) -> None:
-        url = f"{self.baseUrl}/chat.delete"
-        headers = {"Authorization": f"Bearer {self.authToken}"}
-        params = {"channel": f"{self.channelId}",
-                  "ts": f"{self.lastMessageTimestamp}"}
-        deletedTimestamp = self.lastMessageTimestamp
+    async def deleteLastMessage(self) -> None:
+        await self.deleteMessage(self.lastMessageTimestamp)
+
+    '''
+    Deletes the message with the given timestamp
+    '''
+
+    async def deleteMessage(self, timestamp) -> None:
         try:
-            response = requests.post(url=url, headers=headers, params=params)
-            if (not response.ok):
-                logging.warning(
-                    f"Unable to delete message: {response.status_code} {response.json()['error']}")
-                return
+            await self.call("chat.delete", {"channel": self.channelId, "ts": timestamp})
         except Exception as e:
-            logging.error(e)
+            logger.warning(f"Unable to delete message: {e}")
             return
-        logging.debug(f"Message with timestamp {deletedTimestamp} deleted.")
+        logger.debug(f"Message with timestamp {timestamp} deleted.")
 
     '''
     Posts the given message text to Slack, returns message timestamp
     '''
 
-    def postMessage(self, messageText) -> None:
-        url = f"{self.baseUrl}/chat.postMessage"
-        headers = {"Authorization": f"Bearer {self.authToken}"}
-        params = {"channel": f"{self.channelId}",
-                  "as_user": "true", "text": f"{messageText}"}
-        try:
-            response = requests.post(url=url, headers=headers, params=params)
-            if (not response.ok):
-                logging.warning(
-                    f"Unable to post message: {response.status_code} {response.json()['error']}")
-                self.getLastMessageTimestamp()
+    async def postMessage(self, messageText) -> str:
+        response = await self.call("chat.postMessage", {
+            "channel": self.channelId, "text": f"{messageText}"})
+        self.lastMessageTimestamp = response["ts"]
+        logger.debug(
+            f"Message posted successfully. New timestamp is {self.lastMessageTimestamp}")
+        return self.lastMessageTimestamp
 
-        except Exception as e:
-            logging.error(e)
-            self.getLastMessageTimestamp()
 
-        self.lastMessageTimestamp = response.json()["ts"]
-        logging.debug(
-            f"Message posted successfully. New timestamp is {self.lastMessageTimestamp}")
+'''
+Removes all of the bot's own messages from the channel:
+python slack.py --cleanup
+'''
+
+
+async def cleanup() -> None:
+    slack = Slack()
+    try:
+        await slack.deleteMessages()
+    finally:
+        await slack.close()
+
+
+if (__name__ == "__main__"):
+    if ("--cleanup" in sys.argv):
+        load_dotenv(".env")
+        logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s",
+                            level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S")
+        asyncio.run(cleanup())
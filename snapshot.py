@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Snapshot class responsible for persisting the bot state across restarts
+
+The state is a small JSON document: per brewer the detector state, state
+flags and the last status each sink delivered, the Slack status message timestamps and
+the Hue light ids. `collect` returns the current document. changed() asks the
+background task for a write, and writes that are requested while one is in
+progress are coalesced into the next. Every write goes to a temporary file
+that replaces the snapshot atomically, so a crash never leaves a torn file.
+'''
+
+
+class Snapshot:
+    def __init__(self, path: str, collect=None):
+        self.path = path
+        self.collect = collect
+        self.writeRequested = asyncio.Event()
+        self.writeTask = None
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable state snapshot {self.path}: {e}")
+            return {}
+        logger.info(f"Resuming from the state saved at {data.get('savedAt')}")
+        return data
+
+    def start(self) -> None:
+        if (self.writeTask is None):
+            self.writeTask = asyncio.create_task(self.writeLoop())
+
+    def changed(self) -> None:
+        self.writeRequested.set()
+
+    '''
+    Stops the background task and writes the final state
+    '''
+
+    async def close(self) -> None:
+        if (self.writeTask):
+            self.writeTask.cancel()
+            try:
+                await self.writeTask
+            except asyncio.CancelledError:
+                pass
+            self.writeTask = None
+        self.write(self.collect())
+
+    async def writeLoop(self) -> None:
+        while (True):
+            await self.writeRequested.wait()
+            self.writeRequested.clear()
+            try:
+                await asyncio.to_thread(self.write, self.collect())
+            except Exception as e:
+                logger.error(f"Failed to write the state snapshot: {e}")
+
+    def write(self, data: dict) -> None:
+        data = dict(data, savedAt=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False) as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, self.path)
@@ -0,0 +1,110 @@
+import json
+import time
+import signal
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+RESTART_DELAY = 1.0  # seconds, doubled for a worker that keeps crashing
+MAX_RESTART_DELAY = 60.0
+STABLE_AFTER = 300.0  # seconds a worker must run before its restart delay resets
+
+
+'''
+Reads a multi-site config, see sites-template.json. Every site is a dict of
+the same variables as .env, with the "defaults" applied first and SITE_NAME
+set to the site name. SENSOR_URL may also be a dict of brewer name to URL.
+Returns (number of workers, list of sites).
+'''
+
+
+def loadSites(path: str) -> tuple[int, list[dict]]:
+    with open(path) as f:
+        config = json.load(f)
+    defaults = config.get("defaults", {})
+    sites = []
+    for site in config.get("sites", []):
+        env = {**defaults, **site}
+        name = str(env.pop("name", "") or f"site{len(sites) + 1}")
+        if (isinstance(env.get("SENSOR_URL"), dict)):
+            env["SENSOR_URL"] = ",".join(f"{brewer}={url}" for brewer, url in env["SENSOR_URL"].items())
+        env = {key: str(value) for key, value in env.items() if value is not None}
+        env["SITE_NAME"] = name
+        sites.append(env)
+    return int(config.get("workers") or 1), sites
+
+
+'''
+Splits the sites into at most `workers` shards of about equal size
+'''
+
+
+def shard(sites: list, workers: int) -> list[list]:
+    shards = [sites[i::workers] for i in range(max(workers, 1))]
+    return [sites for sites in shards if sites]
+
+
+'''
+Supervisor class responsible for running shards of sites in worker processes
+
+Each worker runs target(index, sites). A worker that exits is restarted with
+the same sites, after a delay that doubles while it keeps crashing. SIGTERM
+and Ctrl-C terminate the workers and return from run().
+'''
+
+
+class Supervisor:
+    def __init__(self, shards: list[list], target):
+        self.shards = shards
+        self.target = target
+        self.processes = {}  # index: Process
+        self.started = {}  # index: monotonic start time
+        self.delays = {}  # index: next restart delay
+        self.stopping = False
+
+    def start(self, index: int) -> None:
+        process = multiprocessing.Process(
+            target=self.target, args=(index, self.shards[index]),
+            name=f"coffeebot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        names = ", ".join(site["SITE_NAME"] for site in self.shards[index])
+        logger.info(f"Worker {index} (pid {process.pid}) runs {names}")
+
+    def stop(self, *_) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(len(self.shards)):
+            self.start(index)
+        restartAt = {}
+        try:
+            while (not self.stopping):
+                now = time.monotonic()
+                for index, process in self.processes.items():
+                    if (process.is_alive() or index in restartAt):
+                        continue
+                    delay = self.delays.get(index, RESTART_DELAY)
+                    if (now - self.started[index] > STABLE_AFTER):
+                        delay = RESTART_DELAY
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, "
+                                 f"restarting in {delay:.0f} s")
+                    restartAt[index] = now + delay
+                    self.delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+                for index, when in list(restartAt.items()):
+                    if (now >= when):
+                        del restartAt[index]
+                        self.start(index)
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes.values():
+                if (process.is_alive()):
+                    process.terminate()
+            for process in self.processes.values():
+                process.join(timeout=30)